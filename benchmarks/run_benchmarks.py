@@ -0,0 +1,280 @@
+"""
+Замеры производительности конвейера на синтетическом корпусе, без библиотеки midi, gpc и music-style-performer.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run_benchmarks --files 64 --output bench.json
+    python -m benchmarks.run_benchmarks --compare bench.json   # сравнение с прошлым замером
+"""
+import argparse
+import contextlib
+import json
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from mido import MidiFile
+
+try:
+    import resource
+except ImportError:  # нет на windows - пиковая память не измеряется
+    resource = None
+
+from music_generation import CPUWrapper, GPCWrapper, apply_instruments_table, combine_pickle_files
+from music_generation.chord_processing import ChordProcessor
+from music_generation.edge_aggregation import aggregate_edges
+from music_generation.fake_gpc import FakeGPC
+from music_generation.graph_store import EDGE_WIDTH
+from music_generation.midi_processing import MidiProcessor
+from music_generation.stylizing import merge_tracks as merge_voices
+from music_generation.vertex_table import VertexTable
+
+from .synthetic_midi import write_corpus
+
+# Таблица инструментов как в popov-music.ipynb
+INSTRUMENTS_TABLE = np.matrix([['Guitar', 1, 40, 60], ['Ahh', 2, 56, 84], ['Violins', 3, 72, 120]])
+
+
+def peak_rss_mb() -> float | None:
+    """ Пиковый размер резидентной памяти процесса (и завершенных дочерних процессов) с начала работы """
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss: байты на macOS, килобайты на linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak * scale / (1 << 20), 1)
+
+
+def timed(repeat: int, function, *args):
+    """
+    Лучшее время из repeat запусков (вывод функции скрыт)
+
+    :return: Время в секундах и результат последнего запуска
+    """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            result = function(*args)
+            best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def stage_result(stage: str, seconds: float, **counts) -> dict:
+    """ Результат этапа: время, количества и пропускная способность (количество в секунду) """
+    result = {'stage': stage, 'seconds': round(seconds, 6)}
+    for name, count in counts.items():
+        result[name] = count
+        result[f'{name}_per_s'] = round(count / seconds, 2) if seconds > 0 else None
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def bench_merge_tracks(midi_paths: list[Path], L: int, repeat: int):
+    """ ChordProcessor.merge_tracks по всем файлам корпуса; возвращает также графы файлов в номерах общей таблицы """
+    chord_processor = ChordProcessor(L)
+    mids = [MidiFile(path, clip=True) for path in midi_paths]
+
+    def run():
+        vertex_table = VertexTable(chord_processor.terminator)
+        graphs = []
+        for mid in mids:
+            file_vertex_table = VertexTable(chord_processor.terminator)
+            df = chord_processor.merge_tracks(pd.DataFrame(columns=['from', 'to', 'atribute']), mid, None, file_vertex_table)
+            remap = vertex_table.merge(file_vertex_table)
+            df['from'] = remap[df['from'].to_numpy()]
+            df['to'] = remap[df['to'].to_numpy()]
+            graphs.append(df)
+        return vertex_table, graphs
+
+    seconds, (vertex_table, graphs) = timed(repeat, run)
+    chords = sum(len(df) for df in graphs)
+    return stage_result('ChordProcessor.merge_tracks', seconds, files=len(mids), chords=chords), vertex_table, graphs
+
+
+def bench_midi_processor(midi_paths: list[Path], L: int, work_dir: Path, use_processes: bool, processes: int, repeat: int):
+    """ MidiProcessor.process (полная обработка: разбор, тональность, запись в хранилище) """
+    def run():
+        result_dir = Path(tempfile.mkdtemp(dir=work_dir))
+        midi_processor = MidiProcessor(ChordProcessor(L), result_dir / "vertices.sqlite", maximum_processes=processes,
+                                       write_merged_midi=False)
+        midi_processor.process(midi_paths, result_dir, use_processes=use_processes, incremental=False)
+        # Количество ребер по индексу хранилища (произведение -> [смещение, количество ребер])
+        return sum(count for shards in midi_processor.graph_store.index['graphs'].values()
+                   for pieces in shards.values() for _, count in pieces.values())
+
+    seconds, edges = timed(repeat, run)
+    stage = f"MidiProcessor.process ({'processes' if use_processes else 'threads'})"
+    return stage_result(stage, seconds, files=len(midi_paths), edges=edges)
+
+
+def bench_combine_pickle_files(graphs: list[pd.DataFrame], L: int, work_dir: Path, repeat: int):
+    """ combine_pickle_files по pcl файлам произведений (устаревший формат библиотеки графов, номера вершин - плотные) """
+    pcl_dir = Path(tempfile.mkdtemp(dir=work_dir))
+    files = []
+    for number, df in enumerate(graphs):
+        filepath = pcl_dir / f"synthetic{number:05d}_C_major.pcl{L}"
+        with open(filepath, 'wb') as file:
+            pickle.dump(df, file, protocol=pickle.HIGHEST_PROTOCOL)
+        files.append(filepath)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)  # устаревший путь замеряется намеренно
+        seconds, df = timed(repeat, combine_pickle_files, files)
+    return stage_result('combine_pickle_files', seconds, files=len(files), edges=len(df))
+
+
+def bench_gpc(vertex_table: VertexTable, edges: pd.DataFrame, work_dir: Path, chord_count: int, max_voice_count: int,
+              seed: int, repeat: int):
+    """ GPCWrapper.insert_graph и generate_midi с FakeGPC вместо ускорителя """
+    # GPCWrapper проверяет наличие sw_kernel и файла обработчиков; FakeGPC их не читает
+    sw_kernel_path, handlers_path = work_dir / "sw-kernel.rawbinary", work_dir / "sw_kernel.h"
+    sw_kernel_path.touch()
+    handlers_path.touch()
+
+    def upload():
+        generator = GPCWrapper(sw_kernel_path, handlers_path, vertex_table, gpc_factory=lambda: FakeGPC(seed))
+        generator.init()
+        generator.insert_graph(edges)
+        return generator
+
+    upload_seconds, generator = timed(repeat, upload)
+    generation_seconds, (edges_count, origin_mid, mono_mid, voice_count) = timed(
+        repeat, generator.generate_midi, chord_count, max_voice_count)
+    generator.close()
+
+    results = [
+        stage_result('GPCWrapper.insert_graph (FakeGPC)', upload_seconds, edges=len(edges)),
+        stage_result('GPCWrapper.generate_midi (FakeGPC)', generation_seconds, chords=chord_count),
+    ]
+    results[0]['upload_bytes'] = len(edges) * EDGE_WIDTH * 8
+    results[0]['seconds_per_million_edges'] = round(upload_seconds * 1e6 / len(edges), 6) if len(edges) else None
+    results[-1]['voices'] = voice_count
+    return results, mono_mid, voice_count
+
+
+def bench_aggregation(vertex_table: VertexTable, edges: pd.DataFrame, work_dir: Path, walk_count: int, walk_length: int,
+                      seed: int, repeat: int):
+    """ Схлопывание повторяющихся ребер, размер загрузки в gpc и скорость выбора следующей вершины на cpu """
+    seconds, aggregated = timed(repeat, aggregate_edges, edges)
+    results = [stage_result('aggregate_edges', seconds, edges=len(edges))]
+    results[-1]['distinct_edges'] = len(aggregated)
+
+    # Загрузка без схлопывания замеряется в bench_gpc
+    def upload():
+        generator = GPCWrapper(work_dir / "sw-kernel.rawbinary", work_dir / "sw_kernel.h", vertex_table,
+                               gpc_factory=lambda: FakeGPC(seed), aggregate=True)
+        generator.init()
+        generator.insert_graph(edges)
+        return generator
+
+    seconds, _ = timed(repeat, upload)
+    results.append(stage_result('GPCWrapper.insert_graph (aggregated, FakeGPC)', seconds, edges=len(aggregated)))
+    results[-1]['upload_bytes'] = len(aggregated) * EDGE_WIDTH * 8
+    results[-1]['seconds_per_million_edges'] = round(seconds * 1e6 / len(aggregated), 6) if len(aggregated) else None
+
+    for aggregate in (False, True):
+        generator = CPUWrapper(vertex_table, seed, aggregate=aggregate)
+        generator.init()
+        generator.insert_graph(edges)
+        seconds, _ = timed(repeat, generator.random_walks, walk_count, walk_length)
+        results.append(stage_result(f"CPUWrapper.random_walks ({'alias tables' if aggregate else 'uniform'})",
+                                    seconds, steps=walk_count * walk_length))
+    return results
+
+
+def bench_orchestration(mono_mid: list[MidiFile], voice_count: int, repeat: int):
+    """ stylizing.merge_tracks (слияние голосов) и apply_instruments_table для результата """
+    seconds, merged_mid = timed(repeat, merge_voices, mono_mid, voice_count)
+    events = len(merged_mid.tracks[0])
+    results = [stage_result('stylizing.merge_tracks', seconds, voices=voice_count, events=events)]
+
+    seconds, _ = timed(repeat, apply_instruments_table, INSTRUMENTS_TABLE, merged_mid)
+    results.append(stage_result('apply_instruments_table', seconds, events=events))
+    return results
+
+
+def compare(results: list[dict], baseline_path: Path, tolerance: float) -> list[str]:
+    """ Этапы, пропускная способность которых упала больше чем на tolerance относительно прошлого замера """
+    with open(baseline_path) as file:
+        baseline = {result['stage']: result for result in json.load(file)['results']}
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['stage'])
+        if previous is None:
+            continue
+        for name, value in result.items():
+            if name.endswith('_per_s') and value and previous.get(name) and value < previous[name] * (1 - tolerance):
+                regressions.append(f"{result['stage']}: {name} {previous[name]} -> {value} "
+                                   f"({100 * (value / previous[name] - 1):.1f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности на синтетическом midi-корпусе")
+    parser.add_argument('--files', type=int, default=32, help="количество синтетических произведений")
+    parser.add_argument('--tracks', type=int, default=4, help="нотных треков в произведении")
+    parser.add_argument('--polyphony', type=int, default=3, help="наибольшее количество нот в аккорде трека")
+    parser.add_argument('--length', type=int, default=200, help="аккордов в треке")
+    parser.add_argument('--tempo-changes', type=int, default=2, help="смен темпа в произведении")
+    parser.add_argument('--L', type=int, default=3, help="количество аккордов в коде вершины")
+    parser.add_argument('--chord-count', type=int, default=2000, help="аккордов в генерируемом произведении")
+    parser.add_argument('--max-voices', type=int, default=128, help="наибольшее количество голосов генерации (как в notebook)")
+    parser.add_argument('--walks', type=int, default=1000, help="одновременных обходов при замере выбора вершин на cpu")
+    parser.add_argument('--walk-length', type=int, default=1000, help="ребер в каждом обходе")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="процессов MidiProcessor")
+    parser.add_argument('--repeat', type=int, default=3, help="запусков каждого этапа (берется лучшее время)")
+    parser.add_argument('--seed', type=int, default=0, help="начальное значение случайного обхода FakeGPC")
+    parser.add_argument('--output', type=Path, help="json с результатами (по умолчанию - стандартный вывод)")
+    parser.add_argument('--compare', type=Path, help="json прошлого замера для поиска регрессий")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое падение пропускной способности")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        midi_paths = write_corpus(work_dir / "corpus", args.files, tracks=args.tracks, polyphony=args.polyphony,
+                                  length=args.length, tempo_changes=args.tempo_changes)
+
+        results = []
+        merge_result, vertex_table, graphs = bench_merge_tracks(midi_paths, args.L, args.repeat)
+        results.append(merge_result)
+        for use_processes in (False, True):
+            results.append(bench_midi_processor(midi_paths, args.L, work_dir, use_processes, args.processes, args.repeat))
+        results.append(bench_combine_pickle_files(graphs, args.L, work_dir, args.repeat))
+
+        edges = pd.concat(graphs, ignore_index=True)
+        gpc_results, mono_mid, voice_count = bench_gpc(vertex_table, edges, work_dir, args.chord_count, args.max_voices,
+                                                       args.seed, args.repeat)
+        results.extend(gpc_results)
+        results.extend(bench_aggregation(vertex_table, edges, work_dir, args.walks, args.walk_length, args.seed,
+                                         args.repeat))
+        results.extend(bench_orchestration(mono_mid, voice_count, args.repeat))
+
+    report = {
+        'parameters': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print("Регрессия:", regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
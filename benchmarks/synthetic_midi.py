@@ -0,0 +1,70 @@
+import random
+from pathlib import Path
+
+from mido import Message, MetaMessage, MidiFile, MidiTrack
+
+TRACK_NAMES = ("Piano", "Strings", "Guitar", "Flute", "Bass", "Drum")  # Bass и Drum пропускаются ChordProcessor
+SCALE = (0, 2, 4, 5, 7, 9, 11)  # до мажор: синтетические произведения в одной тональности
+
+
+def synthetic_midi(seed: int, tracks=4, polyphony=3, length=200, tempo_changes=2, ticks_per_beat=480) -> MidiFile:
+    """
+    Детерминированное синтетическое произведение (midi type 1): одинаковые параметры дают одинаковый файл
+
+    :param seed: Номер произведения - начальное значение генератора случайных чисел
+    :param tracks: Количество нотных треков (кроме трека темпа)
+    :param polyphony: Наибольшее количество одновременно звучащих нот в аккорде трека
+    :param length: Количество аккордов в каждом треке
+    :param tempo_changes: Количество смен темпа в треке темпа
+    :param ticks_per_beat: Разрешение файла
+    """
+    rnd = random.Random(seed)
+    mid = MidiFile(type=1, ticks_per_beat=ticks_per_beat)
+
+    # Трек темпа: смены темпа равномерно по длительности произведения (аккорд в среднем длится четверть)
+    tempo_track = MidiTrack()
+    mid.tracks.append(tempo_track)
+    tempo_track.append(MetaMessage('set_tempo', tempo=rnd.choice((400_000, 500_000, 600_000)), time=0))
+    for _ in range(tempo_changes):
+        tempo_track.append(MetaMessage('set_tempo', tempo=rnd.randrange(300_000, 800_000),
+                                       time=length * ticks_per_beat // (tempo_changes + 1)))
+    tempo_track.append(MetaMessage('end_of_track', time=0))
+
+    for track_number in range(tracks):
+        track = MidiTrack()
+        mid.tracks.append(track)
+        track.append(MetaMessage('track_name', name=TRACK_NAMES[track_number % len(TRACK_NAMES)], time=0))
+        channel = track_number % 16 if track_number % 16 != 9 else 10  # 10 канал (9 в mido) - перкуссия
+        octave = 36 + 12 * (track_number % 4)
+        for _ in range(length):
+            notes = sorted({octave + SCALE[rnd.randrange(len(SCALE))] + 12 * rnd.randrange(2)
+                            for _ in range(rnd.randint(1, polyphony))})
+            pause = rnd.choice((0, 0, ticks_per_beat // 4, ticks_per_beat // 2))
+            duration = rnd.choice((ticks_per_beat // 2, ticks_per_beat, 2 * ticks_per_beat))
+            for index, note in enumerate(notes):
+                track.append(Message('note_on', channel=channel, note=note, velocity=rnd.randint(40, 100),
+                                     time=0 if index else pause))
+            for index, note in enumerate(notes):
+                # часть файлов выключает ноты через note_on с velocity=0
+                message_type = 'note_off' if (seed + index) % 2 else 'note_on'
+                track.append(Message(message_type, channel=channel, note=note, velocity=0,
+                                     time=0 if index else duration))
+        track.append(MetaMessage('end_of_track', time=0))
+
+    return mid
+
+
+def write_corpus(folder: Path, count: int, **parameters) -> list[Path]:
+    """
+    Запись синтетического корпуса: произведения с номерами 0..count-1
+
+    :param parameters: Параметры synthetic_midi
+    :return: Пути к файлам
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for seed in range(count):
+        path = folder / f"synthetic{seed:05d}.mid"
+        synthetic_midi(seed, **parameters).save(path)
+        paths.append(path)
+    return paths
@@ -1,12 +1,200 @@
-from os import system as execute_command
+import hashlib
+import io
+import math
+import os
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import NamedTuple
+
+from mido import MetaMessage, Message, MidiFile, MidiTrack
+
+from . import metrics
+
+# timidity, остановленный ffmpeg после -to, завершается по SIGPIPE (на windows сигнала нет)
+SIGPIPE_RETURNCODE = -signal.SIGPIPE if hasattr(signal, 'SIGPIPE') else None
+HASH_SUFFIX = ".render-hash"  # рядом с mp3 хранится хэш входных данных, из которых он получен
+
+
+class RenderResult(NamedTuple):
+    mp3_output: Path
+    returncode: int | None  # код завершения кодировщика или синтезатора, если он завершился с ошибкой (None - процесс не запустился)
+    seconds: float
+    skipped: bool  # mp3 для тех же midi и конфигурации уже есть
+
+
+def truncate_midi(mid: MidiFile, max_duration: float, tempo_percent: float = 100) -> MidiFile | None:
+    """
+    Обрезка midi до времени звучания: события после max_duration секунд отбрасываются, звучащие ноты выключаются
+
+    :param mid: Исходный midi
+    :param max_duration: Время звучания в секундах
+    :param tempo_percent: Поправка темпа timidity (-T): 100 - темп файла, 40 - в 2.5 раза медленнее
+    :return: Обрезанный midi или None, если весь файл укладывается во время звучания
+    """
+    # Карта темпов (сообщения set_tempo из всех треков) по абсолютному времени в тиках
+    tempo_changes = []
+    last_tick = 0
+    for track in mid.tracks:
+        tick = 0
+        for message in track:
+            tick += message.time
+            if message.type == "set_tempo":
+                tempo_changes.append((tick, message.tempo))
+        last_tick = max(last_tick, tick)
+    tempo_changes.sort(key=lambda change: change[0])
+
+    # Тик, на котором время звучания достигает max_duration (с учетом поправки темпа)
+    remaining = max_duration * 1_000_000 * tempo_percent / 100  # микросекунд в темпе файла
+    cutoff_tick, tempo = 0, 500_000
+    for change_tick, change_tempo in tempo_changes + [(last_tick, None)]:
+        segment = (change_tick - cutoff_tick) * tempo / mid.ticks_per_beat
+        if segment >= remaining:
+            break
+        remaining -= segment
+        cutoff_tick = change_tick
+        if change_tempo is not None:
+            tempo = change_tempo
+    else:
+        return None  # файл короче времени звучания
+    cutoff_tick += math.ceil(remaining * mid.ticks_per_beat / tempo)
+
+    truncated = MidiFile(type=mid.type, ticks_per_beat=mid.ticks_per_beat)
+    for track in mid.tracks:
+        truncated_track = MidiTrack()
+        truncated.tracks.append(truncated_track)
+        tick = 0
+        sounding = set()  # (канал, нота) звучащих нот
+        for message in track:
+            if tick + message.time > cutoff_tick:
+                break
+            tick += message.time
+            truncated_track.append(message)
+            if message.type == "note_on" and message.velocity > 0:
+                sounding.add((message.channel, message.note))
+            elif message.type in ("note_on", "note_off"):
+                sounding.discard((message.channel, message.note))
+        else:
+            continue  # трек закончился раньше, обрезать нечего
+
+        # Выключаем звучащие ноты в момент обрезки
+        delta = cutoff_tick - tick
+        for channel, note in sorted(sounding):
+            truncated_track.append(Message('note_off', channel=channel, note=note, velocity=0, time=delta))
+            delta = 0
+        truncated_track.append(MetaMessage('end_of_track', time=delta))
+    return truncated
 
 
 class MidiToMp3Converter:
-    def __init__(self, script_path: Path, tempo: int, max_duration: int):
-        self.script_path = script_path
+    def __init__(self, config_dir: Path, tempo: int, max_duration: int, max_concurrent: int | None = None):
+        """
+        :param config_dir: Рабочая папка timidity: в ней лежат timidity.cfg и конфигурации заданий
+        :param max_concurrent: Наибольшее количество одновременных преобразований
+        """
+        self.config_dir = config_dir
         self.tempo = tempo
         self.max_duration = max_duration
+        self.max_concurrent = max_concurrent or os.cpu_count() or 1
+
+    def convert(self, config: Path | str, mid_input: Path | str, mp3_output: Path | str) -> RenderResult:
+        return self.render([(config, mid_input, mp3_output)])[0]
+
+    def render(self, jobs: list[tuple[Path | str, Path | str, Path | str]]) -> list[RenderResult]:
+        """
+        Одновременное преобразование нескольких midi в mp3 (не более max_concurrent сразу)
+
+        :param jobs: Задания (конфигурация timidity, midi, mp3)
+        :return: Результаты в порядке заданий
+        """
+        with metrics.timer('render.render', jobs=len(jobs), concurrent=self.max_concurrent) as fields:
+            with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+                results = list(executor.map(lambda job: self._render_job(*job), jobs))
+            for result in results:
+                metrics.event('render.job', mp3=str(result.mp3_output), returncode=result.returncode,
+                              seconds=round(result.seconds, 6), skipped=result.skipped)
+                if result.returncode not in (0, None):
+                    print(f"Не удалось получить {result.mp3_output}: код завершения {result.returncode}")
+            fields.update(skipped=sum(result.skipped for result in results),
+                          failed=sum(result.returncode != 0 for result in results))
+        return results
+
+    def _job_hash(self, config: Path, mid_input: Path) -> str:
+        """ Хэш всего, от чего зависит mp3: midi, конфигурации timidity и настроек преобразования """
+        content_hash = hashlib.sha256(f"{self.tempo}:{self.max_duration}".encode())
+        for path in (mid_input, config, self.config_dir / "timidity.cfg"):
+            content_hash.update(path.read_bytes() if path.exists() else str(path).encode())
+        return content_hash.hexdigest()
+
+    def _midi_content(self, mid_input: Path) -> bytes:
+        """ Содержимое midi для синтеза: только та часть, которая попадет в mp3 """
+        mid = MidiFile(mid_input, clip=True)
+        truncated = truncate_midi(mid, self.max_duration, self.tempo)
+        if truncated is None:
+            return mid_input.read_bytes()
+        buffer = io.BytesIO()
+        truncated.save(file=buffer)
+        return buffer.getvalue()
+
+    def _commands(self, config: Path | str, mp3_output: Path) -> tuple[list[str], list[str]]:
+        """
+        Конвейер в виде списков аргументов: timidity читает midi из stdin и пишет wav в stdout,
+        ffmpeg кодирует его в mp3
+        """
+        synthesizer = ["timidity", "-c", str(config), "-p", "128", "--config-file=./timidity.cfg", "-T", str(self.tempo),
+                       "-", "-Ow", "-o", "-"]
+        encoder = ["ffmpeg", "-y", "-i", "-", "-acodec", "libmp3lame", "-ss", "0", "-to", str(self.max_duration),
+                   "-ab", "256k", str(mp3_output)]
+        return synthesizer, encoder
+
+    def _render_job(self, config: Path | str, mid_input: Path | str, mp3_output: Path | str) -> RenderResult:
+        start = time.perf_counter()
+        cwd = self.config_dir
+        mid_input, mp3_output = Path(mid_input).absolute(), Path(mp3_output).absolute()
+
+        hash_path = mp3_output.with_name(mp3_output.name + HASH_SUFFIX)
+        job_hash = self._job_hash(cwd / config, mid_input)
+        if mp3_output.exists() and hash_path.exists() and hash_path.read_text() == job_hash:
+            return RenderResult(mp3_output, 0, time.perf_counter() - start, True)
+        # Старый mp3 удаляется, чтобы при ошибке не остался устаревший результат
+        hash_path.unlink(missing_ok=True)
+        mp3_output.unlink(missing_ok=True)
+
+        # Синтезируется только сохраняемая часть: время синтеза пропорционально длине mp3, а не произведения
+        try:
+            midi_content = self._midi_content(mid_input)
+        except (OSError, EOFError, ValueError) as error:
+            print(f"Не удалось прочитать {mid_input}", type(error).__name__, "–", error)
+            return RenderResult(mp3_output, None, time.perf_counter() - start, False)
+
+        synthesizer, encoder = self._commands(config, mp3_output)
+        synthesizer_process = None
+        try:
+            synthesizer_process = subprocess.Popen(synthesizer, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd)
+            encoder_process = subprocess.Popen(encoder, stdin=synthesizer_process.stdout, stdout=subprocess.DEVNULL,
+                                               stderr=subprocess.DEVNULL, cwd=cwd)
+        except OSError as error:
+            if synthesizer_process is not None:
+                synthesizer_process.kill()
+                synthesizer_process.wait()
+            print(f"Не удалось запустить преобразование {mid_input}", type(error).__name__, "–", error)
+            return RenderResult(mp3_output, None, time.perf_counter() - start, False)
+        synthesizer_process.stdout.close()  # timidity получит SIGPIPE, если ffmpeg завершится раньше (после -to)
+        try:
+            synthesizer_process.stdin.write(midi_content)
+            synthesizer_process.stdin.close()
+        except BrokenPipeError:
+            pass  # timidity завершился, не дочитав midi - ошибку покажет код завершения
+        returncode = encoder_process.wait()
+        synthesizer_returncode = synthesizer_process.wait()
+        # SIGPIPE после успешного ffmpeg - timidity остановлен на max_duration, это не ошибка
+        if returncode == 0 and synthesizer_returncode not in (0, SIGPIPE_RETURNCODE):
+            returncode = synthesizer_returncode
 
-    def convert(self, config: Path | str, mid_input: Path | str, mp3_output: Path | str):
-        execute_command(f"{self.script_path} {self.tempo} {self.max_duration} {mid_input} {mp3_output} {config}")
+        if returncode == 0:  # результат пропускается при следующем запуске только после успеха обоих процессов
+            hash_path.write_text(job_hash)
+        else:
+            mp3_output.unlink(missing_ok=True)  # частично записанный mp3 не выдается за результат
+        return RenderResult(mp3_output, returncode, time.perf_counter() - start, False)
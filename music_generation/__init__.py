@@ -1,44 +1,127 @@
 # Функция определяет минимальный номер голоса, в котором нет активной ноты
 import os
 import pickle
+import re
+import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from mido import MidiFile, Message, UnknownMetaMessage
+from mido import MidiFile
 
+from .cpu_wrapper import CPUWrapper
 from .gpc_wrapper import GPCWrapper
+from .graph_store import GraphStore
+from .instruments import InstrumentsTable
 from .stylizing import PerformerWrapper
 from .MidiToMp3Converter import MidiToMp3Converter
+from .session import GenerationSession
+from .vertex_store import VertexStore
+from .vertex_table import VertexTable
+
+
+PCL_CATALOG_FILENAME = "pcl_catalog.pickle"  # каталог pcl файлов папки: (тональность, L) -> имена файлов
+PCL_NAME_PATTERN = re.compile(r".*_(?P<tonality>[^_]+_[^_]+)\.pcl(?P<L>\d+)$")
+# Столбцы pcl файлов старого формата: вершины - коды окон аккордов и их crc32, а не номера словаря VertexStore
+LEGACY_PCL_COLUMNS = ('from_crc32', 'to_crc32')
+PCL_DEPRECATION = ("pcl graph libraries are deprecated: graphs are stored in GraphStore shards, "
+                   "vertices in VertexStore; rebuild legacy libraries from midi with MidiProcessor")
+
+
+def _build_pcl_catalog(from_path: Path) -> dict[tuple[str, int], list[str]]:
+    catalog = defaultdict(list)
+    with os.scandir(from_path) as entries:
+        for entry in entries:
+            match = PCL_NAME_PATTERN.match(entry.name)
+            if match:
+                catalog[(match['tonality'], int(match['L']))].append(entry.name)
+    return dict(catalog)
+
+
+def get_pcl_catalog(from_path: Path) -> dict[tuple[str, int], list[str]]:
+    """
+    Каталог pcl файлов папки, сохраненный рядом с ними.
+    Папка сканируется заново только если изменилось время ее изменения (добавление или удаление файлов)
+    """
+    catalog_path = from_path / PCL_CATALOG_FILENAME
+    try:
+        with open(catalog_path, 'rb') as f:
+            content = pickle.load(f)
+        if content['mtime_ns'] == from_path.stat().st_mtime_ns:
+            return content['files']
+    except (FileNotFoundError, EOFError, pickle.PickleError, KeyError, TypeError):
+        pass
+
+    try:
+        # Создание файла каталога меняет время изменения папки, а перезапись существующего файла - нет:
+        # файл создается до чтения времени, чтобы сохраненный каталог не считался устаревшим при следующем вызове
+        catalog_path.touch()
+        writable = True
+    except OSError:
+        writable = False  # библиотека может быть доступна только для чтения - тогда просто работаем без сохранения каталога
+    # Время изменения папки взято до сканирования: файл, добавленный во время сканирования, вызовет повторное сканирование
+    mtime_ns = from_path.stat().st_mtime_ns
+    files = _build_pcl_catalog(from_path)
+    if writable:
+        try:
+            with open(catalog_path, 'wb') as out:
+                pickle.dump({'mtime_ns': mtime_ns, 'files': files}, out, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+    return files
 
 
 def get_files_with_params(from_path: Path, tonality: str, L: int) -> list[Path]:
     """
     Возвращает список файлов из папки `from_path`,
     у которых тональность `tonality` и количество аккордов для кода вершины `L`.
-    Используется фильтр по маске f'{tonality}.pcl{L}'
+    Файлы берутся из каталога папки (см. `get_pcl_catalog`) по имени вида f'..._{tonality}.pcl{L}'.
+    Устарело: MidiProcessor записывает графы в GraphStore (см. GraphStore.load_edges)
 
     :param from_path: Путь к папке, из файлов которой будет поиск
     :param tonality: параметр тональности
     :param L: параметр L (количество аккордов для кода вершины)
     :return: Список файлов с искомыми параметрами
     """
+    warnings.warn(PCL_DEPRECATION, DeprecationWarning, stacklevel=2)
     assert from_path.exists() and from_path.is_dir()
-    file_mask = f'{tonality}.pcl{L}'
-    return [from_path / Path(file_name) for file_name in os.listdir(from_path) if file_name.endswith(file_mask)]
-
-
-def combine_pickle_files(files: list[Path], output_filepath: Path | None = None) -> pd.DataFrame:
-    """ Функция объединяет несколько pcl файлов в один (полезно, когда в библиотеке много малых pcl файлов) """
-    df = pd.DataFrame(columns=['from', 'to', 'from_crc32', 'to_crc32', 'atribute'])  # Initialize an empty DataFrame to store the merged data
+    return [from_path / file_name for file_name in get_pcl_catalog(from_path).get((tonality, L), [])]
+
+
+def _read_pickle_graph(filepath: Path) -> pd.DataFrame | None:
+    try:
+        with open(filepath, 'rb') as f:
+            content = pickle.load(f)
+    except Exception as e:
+        print(f"Pcl file {filepath} error: {e}")
+        return None
+    if not isinstance(content, pd.DataFrame):
+        return None
+    # Коды вершин старого формата не совпадают с номерами словаря: генерация выдала бы чужие аккорды без ошибки
+    if any(column in content.columns for column in LEGACY_PCL_COLUMNS) or len(content) and not all(
+            pd.api.types.is_integer_dtype(content[column]) for column in ('from', 'to') if column in content.columns):
+        raise ValueError(f"Pcl file {filepath} has crc32 vertex codes of the legacy format; {PCL_DEPRECATION}")
+    return content
+
+
+def combine_pickle_files(files: list[Path], output_filepath: Path | None = None, workers=8) -> pd.DataFrame:
+    """
+    Функция объединяет несколько pcl файлов в один (полезно, когда в библиотеке много малых pcl файлов).
+    Файлы читаются пулом потоков, а объединение выполняется один раз в конце. Потоки перекрывают только ожидание
+    чтения с диска: разбор pickle выполняется под GIL, параллельно файлы не разбираются.
+    Устарело: MidiProcessor записывает графы в GraphStore. Принимаются только pcl с номерами вершин словаря VertexStore;
+    для pcl старого формата (вершины - crc32 кодов окон аккордов) выдается ValueError
+    """
+    warnings.warn(PCL_DEPRECATION, DeprecationWarning, stacklevel=2)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = [content for content in executor.map(_read_pickle_graph, files) if content is not None]
 
-    for filepath in files:
-        try:
-            with open(filepath, 'rb') as f:
-                content = pickle.load(f)
-                if isinstance(content, pd.DataFrame):
-                    df = pd.concat([df, content], ignore_index=True)
-        except Exception as e:
-            print(f"Pcl file {filepath} error: {e}")
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=['from', 'to', 'atribute'])
 
     if output_filepath:
         with open(output_filepath, 'wb') as out:
@@ -47,38 +130,15 @@ def combine_pickle_files(files: list[Path], output_filepath: Path | None = None)
     return df
 
 
-def apply_instruments_table(instruments_table, input_mid):
-    # Распределяем по инструменам стилизованный миди
-    result_mid = MidiFile()
-    result_mid.ticks_per_beat = 120
-    result_mid.type = 1
-    print("Instruments:")
-    instrument_count, nu = instruments_table.shape
-    for i in range(instrument_count):
-        print("\t", instruments_table.item((i, 0)))
-        result_mid.add_track(instruments_table.item((i, 0)))
-        # Set the instrument
-        result_mid.tracks[i].append(Message('control_change', control=0, value=0x00, channel=i, time=0))
-        result_mid.tracks[i].append(Message('control_change', control=32, value=0x00, channel=i, time=0))
-        result_mid.tracks[i].append(Message('program_change', program=int(instruments_table.item((i, 1))), channel=i, time=0))  # MIDI file contain instruments from #0
-
-    # используем время для отсчета событий
-    last_event_time = [0] * instrument_count  # начальное время инструмента = 0
-    time = 0  # Время нарастающим итогом для отсчета интервалов
-
-    # Делим единый трек на инструменты
-    for track in input_mid.tracks:
-        for msg in track:
-            time += msg.time
-            for i in range(instrument_count):
-                if msg.type in ("note_on", "note_off"):
-                    if int(instruments_table.item((i, 2))) <= msg.note <= int(instruments_table.item((i, 3))):
-                        result_mid.tracks[i].append(Message(msg.type, channel=i, note=msg.note, velocity=msg.velocity, time=time - last_event_time[i]))
-                        last_event_time[i] = time
-
-    for i in range(instrument_count):
-        result_mid.tracks[i].append(UnknownMetaMessage(type_byte=123, time=0))  # MetaMessage('end_of_track')
-
-    return result_mid
+def apply_instruments_table(instruments_table: InstrumentsTable | np.matrix, input_mid: MidiFile) -> MidiFile:
+    """
+    Распределяет ноты midi по инструментам
+
+    :param instruments_table: Таблица инструментов или матрица [["Название", "Номер инструмента", "Нижняя граница", "Верхняя граница"], ...]
+    :param input_mid: Midi для распределения (например, стилизованный)
+    """
+    if not isinstance(instruments_table, InstrumentsTable):
+        instruments_table = InstrumentsTable.from_matrix(instruments_table)
+    return instruments_table.apply(input_mid)
 
 
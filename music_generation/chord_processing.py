@@ -1,12 +1,17 @@
-import itertools
 import pathlib
 import sys
-from collections import defaultdict
-from typing import NamedTuple
+from array import array
+from functools import lru_cache
+from typing import Iterator
 
+import numpy as np
 import pandas as pd
 from mido import MidiFile, Message, MidiTrack
-from music21.chord import Chord
+
+from . import metrics
+from .midi_events import NOTE_OFF, NOTE_ON, MidiEvents, decode_midi
+from .track_merge import merge_streams, with_delta_times
+from .vertex_table import VertexTable
 
 
 # определяем ноту по номеру (см. midi формат)
@@ -38,217 +43,287 @@ def shift(new_chord, chord_sequence):
     return chord_sequence
 
 
+# Созвучность множества классов высот (нот без учета октавы), как в music21 Chord.isConsonant:
+#  один класс - созвучно; два - если интервал от баса в тесном расположении - унисон, терция, квинта или секста;
+#  три - мажорное или минорное трезвучие не во втором обращении (кварта от баса).
+# Множество задается 12-битной маской интервалов от баса (бит 0 - бас) - интервалы считаются в полутонах
+_CONSONANT_INTERVALS = (3, 4, 7, 8, 9)
+_TRIADS = ((0, 4, 7), (0, 3, 7))  # мажорное и минорное трезвучие от основного тона
+
+
+def _is_consonant_mask(mask: int) -> bool:
+    if not mask & 1:
+        return False  # бас должен входить в множество
+    intervals = [interval for interval in range(12) if mask >> interval & 1]
+    if len(intervals) == 1:
+        return True
+    if len(intervals) == 2:
+        return intervals[1] in _CONSONANT_INTERVALS
+    if len(intervals) == 3:
+        for root in range(12):
+            for triad in _TRIADS:
+                if sorted((root + step) % 12 for step in triad) == intervals:
+                    return (root + triad[2]) % 12 != 0  # квинта трезвучия в басу - второе обращение
+    return False
+
+
+# Таблица созвучности для всех 4096 множеств классов высот относительно баса
+CONSONANT_MASKS = np.array([_is_consonant_mask(mask) for mask in range(1 << 12)], dtype=bool)
+
+
+def _interval_mask(notes, bass: int) -> int:
+    """ Маска интервалов (в пределах октавы) нот относительно баса """
+    mask = 0
+    for note in notes:
+        mask |= 1 << (note - bass) % 12
+    return mask
+
+
+def is_consonant(chord) -> bool:
+    return len(chord) > 0 and bool(CONSONANT_MASKS[_interval_mask(chord, min(chord))])
+
+
 # Найдем максимальное сочетание нот аккорда, являющееся созвучным (консонантный аккорд)
 def consonant(chord):
-    src_chord = Chord(chord)
-    rem = src_chord.removeRedundantPitchNames(inPlace=True)
-    max_chord_len = min([len(chord), 5])
+    if len(chord) == 0:
+        return chord
+    return _best_consonant(tuple(chord))
+
+
+@lru_cache(maxsize=1 << 16)
+def _best_consonant(chord: tuple[int, ...]) -> tuple[int, ...]:
     # Если аккорд созвучный, то возвращаем без изменений
-    if src_chord.isConsonant():
+    if is_consonant(chord):
         return chord
 
-    # Иначе пробуем удалить ноты (вплоть до одной ноты в аккорде), чтобы получить максимальный созвучный акорд
-    best_chord_length = 1
-    best_chord = Chord([chord[0]])
-    best_chord_notes = [chord[0]]
-    for note_count in range(1, len(chord) + 1):
-        # Получим все сочетания из note_count нот
-        chord_list = itertools.combinations(chord, max_chord_len + 1)
-        # Для каждого сочетания проверим созвучность
-        for i in list(chord_list):
-            cur_chord = Chord(i)
-            if cur_chord.isConsonant() and len(i) > best_chord_length:
-                best_chord_notes = i
-                best_chord_length = len(i)
+    # Иначе перебираем бас и созвучные подмножества классов высот над ним (по таблице) и оставляем
+    # сочетание с наибольшим количеством нот. Нота, выбранная басом, сохраняет порядок нот исходного аккорда
+    best_chord_notes = chord[:1]
+    for bass in sorted(set(chord)):
+        upper_notes = [note for note in chord if note >= bass]
+        if len(upper_notes) <= len(best_chord_notes):
+            break  # выше лежит еще меньше нот
+        mask = _interval_mask(upper_notes, bass)
+        # Все подмножества маски, содержащие бас
+        submask = mask
+        while submask:
+            if submask & 1 and CONSONANT_MASKS[submask]:
+                notes = tuple(note for note in upper_notes if submask >> (note - bass) % 12 & 1)
+                if len(notes) > len(best_chord_notes):
+                    best_chord_notes = notes
+            submask = (submask - 1) & mask
     return best_chord_notes
 
 
-class NoteEvent(NamedTuple):
-    type: str
-    note: int
-    velocity: float
+# Строка аккордов вершины для отладочной печати
+def chord_sequence_string(chord_sequence, sorted_chord) -> str:
+    chord_string = ""
+    for chord in chord_sequence[1:]:
+        for n in chord:
+            chord_string += " " + decode_note(int(n))
+        chord_string += " -->"
+    for n in sorted_chord:
+        chord_string += " " + decode_note(int(n))
+    return chord_string
 
 
-class ChordProcessor:
-    MS_PER_BEAT_DEFAULT = 500_000 # начальное значение по стандарту, далее уточняется в треке через сообщение set_tempo
+class EdgeBuffer:
+    """
+    Накопитель ребер графа де Брюйна: добавление ребра - амортизированное O(1),
+    DataFrame строится один раз в конце разбора
+    """
 
-    def __init__(self, L: int, terminator: int = 0, banned_instruments=("Bass", "Drum"), debug=False):
+    def __init__(self):
+        # Типизированные столбцы: номера вершин и время между аккордами
+        self.from_vertices = array('Q')
+        self.to_vertices = array('Q')
+        self.atributes = array('Q')
+
+    def __len__(self):
+        return len(self.atributes)
+
+    def append(self, from_vertex: int, to_vertex: int, atribute: int):
+        self.from_vertices.append(from_vertex)
+        self.to_vertices.append(to_vertex)
+        self.atributes.append(atribute)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            'from': np.frombuffer(self.from_vertices, dtype=np.uint64),
+            'to': np.frombuffer(self.to_vertices, dtype=np.uint64),
+            'atribute': np.frombuffer(self.atributes, dtype=np.uint64),
+        })
+
+
+class ChordProcessor:
+    def __init__(self, L: int, terminator: int = 0, banned_instruments=("Bass", "Drum"), extract_consonant=False,
+                 debug=False):
+        """
+        :param extract_consonant: Заменять каждый аккорд его наибольшим созвучным сочетанием нот (см. consonant).
+                                  Графы с выделением созвучий лучше хранить в отдельной папке результатов
+        """
         assert L > 2
 
         self.L = L
         self.terminator = terminator
         self.banned_instruments = banned_instruments
+        self.extract_consonant = extract_consonant
         self.debug = debug
 
-    def _merge_track(self, mid: MidiFile) -> dict[int, list[NoteEvent]]:
+    def parameters_key(self) -> tuple:
+        """ Параметры, от которых зависит граф (для проверки актуальности ранее обработанных файлов) """
+        key = self.L, self.terminator, tuple(self.banned_instruments)
+        if self.extract_consonant:
+            key += ("consonant",)  # без выделения созвучий ключ прежний - ранее обработанные файлы остаются актуальными
+        return key
+
+    def _merge_track(self, midi: MidiEvents) -> Iterator[tuple[int, tuple[str, int, int]]]:
         """
         Объединение треков - делаем из mid.type 1 (sync tracks) в mid.type 0 (single track)
 
-        :param mid: Загруженный Midi-файл
-        :param banned_instruments: Инструменты, которые нужно проигнорировать
-        :return:
+        :param midi: Нотные события midi-файла
+        :return: Поток событий объединенного трека (время в масштабе 120 ударов в минуту, (тип, нота, velocity)) по времени
         """
-        ticks_per_beat = mid.ticks_per_beat
-
-        # Запишем время события из каждого трека в dictionary, каждый элемент которого - массив сообщений в данный момент времени
-        merged_track = defaultdict(list)
-        # Для каждого трека
-        for track in mid.tracks:
-            if any([(banned_instrument in track.name) for banned_instrument in self.banned_instruments]):
+        events = midi.events
+        # Время сообщения для темпа 120 ударов в минуту (время в сообщениях измеряется в ticks), темп - из того же трека
+        ms_per_tick = events['tempo'] / midi.ticks_per_beat
+        steps = (120 * events['delta'].astype(np.int64) * ms_per_tick / 500_000).astype(np.int64)  # TODO: непонятно, почему делим на какие-то 500_000?
+
+        # Пропускаем треки запрещенных инструментов и перкуссию (10 канал по стандарту МИДИ используется для перкуссии.)
+        banned_tracks = [any(banned_instrument in name for banned_instrument in self.banned_instruments)
+                         for name in midi.track_names]
+        keep = events['channel'] != 10
+        # Если time_on и velocity=0, то это событие равнозначно note_off
+        message_types = np.where((events['type'] == NOTE_ON) & (events['velocity'] > 0), "note_on", "note_off")
+
+        streams = []
+        for start, end in midi.track_bounds():
+            if banned_tracks[events['track'][start]]:
                 continue
-
-            # Начальный масштаб времени, отнесенный к 120 ударам в минуту
-            ms_per_beat = self.MS_PER_BEAT_DEFAULT  # начальное значение по стандарту, далее уточняется в треке через сообщение set_tempo
-            ms_per_tick = ms_per_beat / ticks_per_beat
-
-            time = 0  # Время нарастающим итогом т.е. рассматриваем разницу между нотами, а не время с самого начала
-            # Для каждого сообщения в треке
-            for message in track:
-                # Eсли сообщение о смене темпа
-                if message.type == "set_tempo":
-                    ms_per_beat = message.tempo
-                    ms_per_tick = ms_per_beat / ticks_per_beat
-                    # time += int(120 * message.time * ms_per_tick / 500_000)  # TODO: кажется, этого тут не должно быть, поэтому закомментим
-                    if self.debug: print(f"Смена темпа на: {int(500_000 / ms_per_tick)}")
-
-                # Если сообщение о нажатии или отпускании ноты
-                elif message.type in ("note_on", "note_off"):
-                    # Расчитаем текущий момент времени для темпа 120 ударов в минуту для нового сообщения (время в сообщениях измеряется в ticks)
-                    time += int(120 * message.time * ms_per_tick / 500_000)  # TODO: непонятно, почему делим на какие-то 500_000?
-                    
-                    # Дизейблим перкуссию (10 канал по стандарту МИДИ используется для перкуссии.)
-                    if message.channel == 10: continue
-
-                    message_type = message.type
-                    # Если time_on и velocity=0, то это событие равнозначно note_off
-                    if message.type == "note_on" and message.velocity == 0:
-                        message_type = "note_off"
-
-                    # Добавим текущее событие к массиву в виде словаря {type, note, velocity}
-                    note = NoteEvent(type=message_type, note=message.note, velocity=message.velocity)
-                    merged_track[time].append(note)
-
-        return merged_track
-
-    def _track_append(self, track: MidiTrack, merged_track: dict[int, list[NoteEvent]]) -> None:
-        previous_time = 0  # Начальная метка времени
-        # Для каждого момента времени в словаре (сортируем его по времени), записываем событие в midi.
-        for time in sorted(merged_track.keys()):
-            if self.debug: print(f"{time}: {merged_track[time]}")
-
-            # Рассчитаем промежуток времени от предыдущего события
-            delta_t = int(time - previous_time)
-
-            # Перебираем все сообщения в текущем моменте времени
-            for event in merged_track[time]:
-                # Формируем сообщение в формате midi
-                track_message = Message(type=event.type, note=event.note, velocity=event.velocity, time=delta_t)
-                track.append(track_message)
-
-                # Все остальные события в этот момент времени имеют delta_t=0
-                delta_t = 0
-
-            # Переключаем момент времени на новую отметку
-            previous_time = time
-
-    def _process_midi_file(self, mid: MidiFile, df: pd.DataFrame) -> pd.DataFrame:
-        # Показать последовательность аккордов и записать ее в csv
-        for track in mid.tracks:  # он должен быть один, так как он смерджен!!!
+            # Время нарастающим итогом внутри трека (с учетом пропущенных событий перкуссии)
+            times = np.cumsum(steps[start:end])
+            track_keep = keep[start:end]
+            streams.append(zip(times[track_keep].tolist(), zip(message_types[start:end][track_keep].tolist(),
+                                                                events['note'][start:end][track_keep].tolist(),
+                                                                events['velocity'][start:end][track_keep].tolist())))
+
+        # Каждый трек упорядочен по времени - сливаем их потоково
+        return merge_streams(streams)
+
+    def _track_append(self, track: MidiTrack, merged_track: Iterator[tuple[int, tuple[str, int, int]]]) -> None:
+        # Промежуток времени от предыдущего события; все остальные события в тот же момент времени имеют delta_t=0
+        for delta_t, (message_type, note, velocity) in with_delta_times(merged_track):
+            if self.debug: print(f"{delta_t}: {message_type} {note} {velocity}")
+            # Формируем сообщение в формате midi
+            track.append(Message(type=message_type, note=note, velocity=velocity, time=delta_t))
+
+    def _process_midi_file(self, midi: MidiEvents, df: pd.DataFrame, vertex_table: VertexTable) -> pd.DataFrame:
+        edges = EdgeBuffer()
+        events = midi.events
+        chord_window = None  # окно аккордов текущей вершины (номер получаем только для вершин, попадающих в граф)
+        # Показать последовательность аккордов и записать ее в csv; треки разбираются независимо, как в исходном файле
+        for start, end in midi.track_bounds():
             time = 0  # время трека, потому что time=time+message.time, а время между нотами = message.time
 
+            chord_window = None
             chord_sequence = init_chord_sequence(self.terminator, self.L)
-            chord_id = chord_sequence[self.L - 1][0]  # формируем аккорд в цифровом значении
-            prev_chord_id = chord_sequence[self.L - 2][0]  # начальный аккорд начинается с нуля - это нужно для графа. берем переменную "предыдущий акк"
+            prev_chord_id = VertexTable.TERMINATOR_ID  # начальный аккорд - терминальная вершина, это нужно для графа. берем переменную "предыдущий акк"
             chord = ()  # список всех нажатых нот в данный момент. т.е наш аккорд
             # prev_chord = () # список всех нажатых нот для предыдущего аккорда
 
-            for message_index, message in enumerate(track):
-                if message.type in ("note_on", "note_off"):
-                    # Напечатаем аккорд, так как он сейчас изменится
-                    if (message.time != 0 and len(chord) > 0) or message_index == len(track):
-                        # len(chord)>0 нужно для фильтрации аккордов и пауз. Мы устанавливаем, что акк не может быть пустым.
-
-                        consonant_chord = chord  # TODO: не используется функция consonant
-                        # consonant_chord = consonant(chord) # Применим алгоритм выделения аккорда наибольшим количеством нот
-
-                        # Отсортируем по ноте, а потом по октаве нынешний и предыдущий аккорд
-                        sorted_chord = sorted(consonant_chord)
-                        sorted_prev_chord = sorted(chord_sequence[self.L - 1])  # Аккорд, который был предыдущим, сохранен в конце массива
-
-                        # Аккорд chord, завершающий свое время жизни, еще не сохранен в массиве и хранится теперь в sorted_chord
-                        # Предыдущий аккорд берем из chord_sequence[L-1]
-                        # Сравним завершающийся аккорд с предыдущим, чтобы понять, что есть изменения
-                        chords_equal = sorted_chord == sorted_prev_chord
-                        # Начнем формирование пакета для записи кода аккорда (целочисленного)
-                        chord_id = 0xE  # 0xE - обозначение начальный символ числа. Обнуляем предыдущий аккорд, чтобы формировать новый аккорд с нуля
-
-                        # Создадим строку для записи аккорда
-                        chord_string = ""
-
-                        # формируем id на основе предыдущего акк + барьер (барьер - это разделение аккордов между предыдущим и текущим)
-                        for i in range(1, self.L):  # 1..L-1  prev_prev_chord in chord_sequence
-                            for n in chord_sequence[i]:  # Ex:(0x70,0x71,0x72,0x73),0x74 Список нажатых клавиш
-                                chord_string += " " + decode_note(int(n))
-                                chord_id = chord_id * 0x100 + int(n)
-                            chord_id = chord_id * 0x100 + 0x0f  # 0xf - обозначение нашего барьера. Это 255 в десятичном виде
-                            chord_string = chord_string + " -->"
-                        for n in sorted_chord:  # Аккорд, завершивший звучание - список нажатых клавиш
-                            chord_string = chord_string + " " + decode_note(int(n))
-                            chord_id = chord_id * 0x100 + int(n)
-                        if not chords_equal:
-                            if self.debug:
-                                print(f"Время: {time}; "
-                                      f"Аккорд: {chord_string}; "
-                                      f"Код пред. вершины: {hex(prev_chord_id)}; "
-                                      f"Код вершины: {chord_id}; "
-                                      f"Номера клавиш: {sorted_prev_chord}-->{sorted_chord}")
-                            df.loc[len(df)] = [str(prev_chord_id), str(chord_id), "", "", int(message.time)]  # добавление в словарь df pandas атрибуты id предыдущего аккорда, id нового аккорда и время между аккордами
-                            # Сохраним предыдущий аккорд, чтобы pandas df сформировалась правильно
-                            prev_chord_id = chord_id
-                            # предыдущий акк становится пред-предыдущим, а текущий = предыдущий (т.е. сдвигаем время)
-                            chord_sequence = shift(chord, chord_sequence)
-                    time += message.time  # обновляем общее время трека и переходим к новому событию
-                    # Добавим запись в таблицу о переходе между аккордами
-                if message.type == "note_on" and message.note not in chord:
-                    # если ноты нет в акк, но событие "нажата", то ноту добавляем в акк
-                    chord += (message.note,)
-                elif message.type == "note_off" and message.note in chord:
+            for event_type, note, delta in zip(events['type'][start:end].tolist(), events['note'][start:end].tolist(),
+                                               events['delta'][start:end].tolist()):
+                # Напечатаем аккорд, так как он сейчас изменится
+                if delta != 0 and len(chord) > 0:
+                    # len(chord)>0 нужно для фильтрации аккордов и пауз. Мы устанавливаем, что акк не может быть пустым.
+
+                    # Применим алгоритм выделения аккорда наибольшим количеством нот
+                    consonant_chord = consonant(chord) if self.extract_consonant else chord
+
+                    # Отсортируем по ноте, а потом по октаве нынешний и предыдущий аккорд
+                    sorted_chord = sorted(consonant_chord)
+                    sorted_prev_chord = sorted(chord_sequence[self.L - 1])  # Аккорд, который был предыдущим, сохранен в конце массива
+
+                    # Аккорд chord, завершающий свое время жизни, еще не сохранен в массиве и хранится теперь в sorted_chord
+                    # Предыдущий аккорд берем из chord_sequence[L-1]
+                    # Сравним завершающийся аккорд с предыдущим, чтобы понять, что есть изменения
+                    chords_equal = sorted_chord == sorted_prev_chord
+                    # Вершина - окно из предыдущих L-1 аккордов и аккорда, завершившего звучание
+                    chord_window = (*chord_sequence[1:], tuple(sorted_chord))
+                    if not chords_equal:
+                        chord_id = vertex_table.intern(chord_window)  # номер вершины в таблице
+                        if self.debug:
+                            # Строка аккорда нужна только для отладочной печати
+                            print(f"Время: {time}; "
+                                  f"Аккорд: {chord_sequence_string(chord_sequence, sorted_chord)}; "
+                                  f"Код пред. вершины: {prev_chord_id}; "
+                                  f"Код вершины: {chord_id}; "
+                                  f"Номера клавиш: {sorted_prev_chord}-->{sorted_chord}")
+                        edges.append(prev_chord_id, chord_id, delta)  # добавление ребра: id предыдущего аккорда, id нового аккорда и время между аккордами
+                        # Сохраним предыдущий аккорд, чтобы pandas df сформировалась правильно
+                        prev_chord_id = chord_id
+                        # предыдущий акк становится пред-предыдущим, а текущий = предыдущий (т.е. сдвигаем время)
+                        chord_sequence = shift(consonant_chord, chord_sequence)
+                time += delta  # обновляем общее время трека и переходим к новому событию
+                # Добавим запись в таблицу о переходе между аккордами
+                if event_type == NOTE_ON and note not in chord:
+                    # если ноты нет в акк, но событие "нажата", то ноту добавляем в акк (note_on с velocity=0 тоже)
+                    chord += (note,)
+                elif event_type == NOTE_OFF and note in chord:
                     # если нота "отпущена", то удаляем из нынешнего акк.
                     # Определим индекс элемента в списке нот аккорда
-                    note_index = chord.index(message.note)  # %12
+                    note_index = chord.index(note)  # %12
                     # Удалим ноту из аккорда, если событие - "отпущена"
                     chord = chord[: note_index] + chord[note_index + 1:]
 
-        df.loc[len(df)] = [str(chord_id), str(self.terminator), "", "", int(0)]
-        return df
+        if len(events) == 0 or events['track'][-1] != len(midi.track_names) - 1:
+            chord_window = None  # последний трек файла без нот - окна нет
+        chord_id = VertexTable.TERMINATOR_ID if chord_window is None else vertex_table.intern(chord_window)
+        edges.append(chord_id, VertexTable.TERMINATOR_ID, 0)
 
-    def merge_tracks(self, df: pd.DataFrame, midi_source_path: pathlib.Path, result_path: pathlib.Path) -> pd.DataFrame:
+        # DataFrame формируется один раз для всех ребер
+        if df.empty:
+            return edges.to_dataframe()
+        return pd.concat([df, edges.to_dataframe()], ignore_index=True)
+
+    def merge_tracks(self, df: pd.DataFrame, midi_source_path: pathlib.Path | MidiFile | MidiEvents,
+                     result_path: pathlib.Path | None, vertex_table: VertexTable) -> pd.DataFrame:
         """
         Объединение треков и формирование последовательности аккордов. Результат записываем в pandas DataFrame
-        :param df: фрейм в формате {"from", "to", "crc32", "atr"}, в который записывается граф де Брюйна
-        :param midi_source_path: исходный файл (удалить)
-        :param result_path: сохраненный миди с аккордами для контроля результатов
+        :param df: фрейм в формате {"from", "to", "atribute"}, в который записывается граф де Брюйна
+        :param vertex_table: таблица, в которой получают номера вершины графа
+        :param midi_source_path: исходный файл, загруженный midi или его уже декодированные нотные события
+        :param result_path: сохраненный миди с аккордами для контроля результатов (None - не сохранять)
         :rtype: pd.DataFrame
         """
-        # создаем переменную mid - наш миди-файл типа 1 (когда треки НЕ смерджены в одну дорожку)
-        mid = MidiFile(midi_source_path, clip=True)
-        if mid.type > 1:
+        # Нотные события midi-файла типа 1 (когда треки НЕ смерджены в одну дорожку) - декодируются один раз
+        if isinstance(midi_source_path, MidiEvents):
+            midi = midi_source_path
+        else:
+            mid = midi_source_path if isinstance(midi_source_path, MidiFile) else MidiFile(midi_source_path, clip=True)
+            midi = decode_midi(mid)
+        if midi.type > 1:
             sys.exit("MIDI file should have Type 1 (all trackes should start sunchronously)")
             # TODO: если будут midi.type 2, то можно будет попробовать что-то с этим сделать через midi-библиотеку
             # print(f"MIDI has type {mid.type}!")
             # return
 
-        merged_track = self._merge_track(mid)
-
-        # Создаем новую переменную для обозначения миди-файла
-        merged_mid = MidiFile()
-        # Темп всегда 120 ударов на четверть (quarter note)
-        merged_mid.ticks_per_beat = 120
-        # Создаем первый и единственный трек
-        merged_mid.add_track('Acoustic Grand Piano')
-        # Добавляем объединённый трек
-        self._track_append(merged_mid.tracks[0], merged_track)
-        # Сохраним объединенный midi в переменную merged_mid
-        merged_mid.save(result_path)
-
-        return self._process_midi_file(mid, df)
+        if result_path is not None:
+            with metrics.timer('chords.write_merged', path=str(result_path)):
+                merged_track = self._merge_track(midi)
+
+                # Создаем новую переменную для обозначения миди-файла
+                merged_mid = MidiFile()
+                # Темп всегда 120 ударов на четверть (quarter note)
+                merged_mid.ticks_per_beat = 120
+                # Создаем первый и единственный трек
+                merged_mid.add_track('Acoustic Grand Piano')
+                # Добавляем объединённый трек
+                self._track_append(merged_mid.tracks[0], merged_track)
+                # Сохраним объединенный midi в переменную merged_mid
+                merged_mid.save(result_path)
+
+        with metrics.timer('chords.process', tracks=len(midi.track_names)) as fields:
+            result = self._process_midi_file(midi, df, vertex_table)
+            fields.update(edges=len(result) - len(df), vertices=len(vertex_table))
+        return result
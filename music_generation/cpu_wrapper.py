@@ -0,0 +1,124 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from . import metrics
+from .edge_aggregation import aggregate_edges, alias_tables
+from .graph_store import as_edge_array
+from .midi_generator import MidiGenerator
+from .vertex_table import VertexTable
+
+
+class CPUWrapper(MidiGenerator):
+    """
+    Обход графа де Брюйна на cpu - замена GPCWrapper на машинах без ускорителя и базовый уровень для сравнения с gpc.
+
+    Граф хранится в виде CSR: ребра отсортированы по начальной вершине, `offsets[v]:offsets[v + 1]` - ребра вершины v.
+    Следующее ребро выбирается равновероятно среди ребер текущей вершины, как в обработчике get_random_vertices.
+
+    С aggregate=True повторяющиеся ребра схлопываются в одно ребро с весом - количеством повторов (время перехода -
+    среднее), а следующее ребро выбирается по таблицам псевдонимов с вероятностью, пропорциональной весу: переходы
+    выпадают так же часто, как среди исходных ребер, но граф занимает столько памяти, сколько в нем различных переходов.
+    """
+
+    def __init__(self, vertex_table: VertexTable, seed: int | None = None, debug=False, aggregate=False):
+        super().__init__(vertex_table, debug)
+
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.aggregate = aggregate
+
+        self.offsets = np.zeros(1, dtype=np.int64)  # начало списка смежности вершины
+        self.targets = np.empty(0, dtype=np.uint64)  # конечные вершины ребер
+        self.atributes = np.empty(0, dtype=np.uint64)  # время ребер
+        self.degrees = np.zeros(0, dtype=np.uint64)  # количество исходных ребер из вершины (с повторами)
+        self.alias_probability: np.ndarray | None = None  # таблицы псевдонимов (только для aggregate=True)
+        self.alias: np.ndarray | None = None
+        self._walk = iter(())
+
+    def init(self):
+        super().init()
+        self.rng = np.random.default_rng(self.seed)
+
+    def insert_graph(self, df: pd.DataFrame | np.ndarray):
+        edges = as_edge_array(df)
+        assert len(edges) > 0, "Graph is empty"
+
+        sources = edges[:, 0].astype(np.int64)
+        vertex_count = max(len(self.vertex_table), int(edges[:, :2].max()) + 1)
+        self.degrees = np.bincount(sources, minlength=vertex_count).astype(np.uint64)
+
+        if self.aggregate:
+            # Переходы уже отсортированы по начальной вершине
+            aggregated = aggregate_edges(edges)
+            weights = aggregated.counts
+            self.targets = aggregated.targets
+            self.atributes = np.rint(aggregated.atribute_mean).astype(np.uint64)
+            distinct_sources = aggregated.sources.astype(np.int64)
+        else:
+            order = np.argsort(sources, kind='stable')
+            self.targets = edges[order, 1]
+            self.atributes = edges[order, 2]
+            distinct_sources = sources
+        self.offsets = np.zeros(vertex_count + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(distinct_sources, minlength=vertex_count))
+
+        if self.aggregate:
+            self.alias_probability, self.alias = alias_tables(self.offsets, weights)
+        else:
+            self.alias_probability, self.alias = None, None
+
+        self._decode_vertices(edges[:, 0])
+
+    def random_walks(self, walk_count: int, length: int, start_vertex=VertexTable.TERMINATOR_ID) -> tuple[np.ndarray, ...]:
+        """
+        Векторизованная генерация сразу многих случайных обходов
+
+        :param walk_count: Количество обходов
+        :param length: Количество ребер в каждом обходе
+        :param start_vertex: Начальная вершина. Из тупика обход переходит в терминальную вершину (ребро с временем 0 и
+                             количеством ребер 0 - генератор завершает звучащие ноты) и продолжается с начальной вершины
+        :return: Массивы (walk_count, length): из вершины, в вершину, время, количество ребер из вершины
+        """
+        if not 0 <= start_vertex < len(self.offsets) - 1 or self.offsets[start_vertex + 1] == self.offsets[start_vertex]:
+            raise ValueError(f"Start vertex {start_vertex} has no outgoing edges")
+
+        from_vertices = np.empty((walk_count, length), dtype=np.uint64)
+        to_vertices = np.empty((walk_count, length), dtype=np.uint64)
+        atributes = np.empty((walk_count, length), dtype=np.uint64)
+        degrees = np.empty((walk_count, length), dtype=np.uint64)
+
+        start = time.perf_counter()
+        current = np.full(walk_count, start_vertex, dtype=np.int64)
+        for step in range(length):
+            degree = self.offsets[current + 1] - self.offsets[current]
+            dead_end = degree == 0
+
+            edge = self.offsets[current] + (self.rng.random(walk_count) * degree).astype(np.int64)
+            edge[dead_end] = 0  # у тупика нет ребер: номер ребра не используется
+            if self.alias is not None:
+                # Взвешенный выбор: позиция принимается с вероятностью alias_probability, иначе берется ее псевдоним
+                edge = np.where(self.rng.random(walk_count) < self.alias_probability[edge], edge, self.alias[edge])
+            from_vertices[:, step] = current
+            to_vertices[:, step] = np.where(dead_end, VertexTable.TERMINATOR_ID, self.targets[edge])
+            atributes[:, step] = np.where(dead_end, 0, self.atributes[edge])
+            degrees[:, step] = self.degrees[current]
+            current = np.where(dead_end, start_vertex, self.targets[edge].astype(np.int64))
+
+        seconds = time.perf_counter() - start
+        metrics.event('cpu.random_walks', walks=walk_count, length=length, weighted=self.alias is not None,
+                      seconds=round(seconds, 6), steps_per_s=round(walk_count * length / seconds, 1) if seconds > 0 else None)
+        return from_vertices, to_vertices, atributes, degrees
+
+    def _start_random_traversal(self, count, start_vertex):
+        walk = self.random_walks(1, int(count), int(start_vertex))
+        self._walk = zip(*(column[0].tolist() for column in walk))
+
+    def _get_random_edge(self):
+        u, v, time, adj_c = next(self._walk)
+
+        if self.debug:
+            print(f"{u}:{v}:{time}:{adj_c}")
+
+        return u, v, time, adj_c
@@ -0,0 +1,95 @@
+import time
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from . import metrics
+from .graph_store import EDGE_WIDTH, as_edge_array
+
+
+class AggregatedEdges(NamedTuple):
+    """ Различные переходы графа (отсортированы по начальной, затем по конечной вершине) со статистикой повторов """
+    sources: np.ndarray  # uint64
+    targets: np.ndarray  # uint64
+    counts: np.ndarray  # uint64: сколько раз переход встречается в исходном графе
+    atribute_mean: np.ndarray  # float64: среднее время перехода
+    atribute_min: np.ndarray  # uint64
+    atribute_max: np.ndarray  # uint64
+
+    def __len__(self):
+        return len(self.sources)
+
+    def as_edge_array(self) -> np.ndarray:
+        """ Ребра (количество переходов, 3) uint64 в формате gpc: время перехода - округленное среднее """
+        edges = np.empty((len(self.sources), EDGE_WIDTH), dtype=np.uint64)
+        edges[:, 0] = self.sources
+        edges[:, 1] = self.targets
+        edges[:, 2] = np.rint(self.atribute_mean)
+        return edges
+
+
+def aggregate_edges(df: pd.DataFrame | np.ndarray) -> AggregatedEdges:
+    """
+    Схлопывание повторяющихся ребер (from, to) в одно ребро с количеством повторов и статистикой времени (atribute)
+
+    :param df: фрейм {"from", "to", "atribute"} или массив ребер (количество ребер, 3) uint64
+    """
+    start = time.perf_counter()
+    edges = as_edge_array(df)
+    if len(edges) == 0:
+        empty = np.empty(0, dtype=np.uint64)
+        return AggregatedEdges(empty, empty, empty, np.empty(0, dtype=np.float64), empty, empty)
+
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    group_start = np.ones(len(edges), dtype=bool)
+    group_start[1:] = (edges[1:, 0] != edges[:-1, 0]) | (edges[1:, 1] != edges[:-1, 1])
+    starts = np.flatnonzero(group_start)
+
+    atributes = edges[:, 2]
+    counts = np.diff(np.append(starts, len(edges))).astype(np.uint64)
+    aggregated = AggregatedEdges(
+        sources=edges[starts, 0],
+        targets=edges[starts, 1],
+        counts=counts,
+        atribute_mean=np.add.reduceat(atributes, starts) / counts,
+        atribute_min=np.minimum.reduceat(atributes, starts),
+        atribute_max=np.maximum.reduceat(atributes, starts),
+    )
+    metrics.event('graph.aggregate', source_edges=len(edges), edges=len(aggregated),
+                  seconds=round(time.perf_counter() - start, 6))
+    return aggregated
+
+
+def alias_tables(offsets: np.ndarray, weights: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Таблицы псевдонимов (метод Воуза) для выбора ребра вершины с вероятностью, пропорциональной весу, за O(1).
+
+    Ребро выбирается так: равновероятно берется позиция k среди ребер вершины и случайное u из [0, 1);
+    если u < probability[k], результат - ребро k, иначе - ребро alias[k].
+
+    :param offsets: CSR: ребра вершины v - offsets[v]:offsets[v + 1]
+    :param weights: Вес каждого ребра
+    :return: Массивы probability (float64) и alias (int64, номера ребер) по ребрам
+    """
+    probability = np.ones(len(weights), dtype=np.float64)
+    alias = np.arange(len(weights), dtype=np.int64)
+
+    degrees = np.diff(offsets)
+    for vertex in np.flatnonzero(degrees > 1).tolist():
+        start, end = int(offsets[vertex]), int(offsets[vertex + 1])
+        vertex_weights = weights[start:end]
+        if vertex_weights.min() == vertex_weights.max():
+            continue  # равные веса: достаточно равновероятного выбора позиции
+
+        scaled = (vertex_weights * ((end - start) / vertex_weights.sum())).tolist()
+        small = [k for k, value in enumerate(scaled) if value < 1.0]
+        large = [k for k, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probability[start + less] = scaled[less]
+            alias[start + less] = start + more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # оставшиеся позиции (в пределах погрешности округления) выбираются всегда: probability = 1
+    return probability, alias
@@ -0,0 +1,79 @@
+import numpy as np
+
+from .cpu_wrapper import CPUWrapper
+from .vertex_table import VertexTable
+
+
+class FakeGPC:
+    """
+    Локальная замена gpc64io.base.GPC для проверки и замеров без ускорителя.
+
+    Повторяет используемую часть api очередей сообщений (start_handler, mq_send_uint64, mq_send_buf, join,
+    mq_receive_uint64, mq_receive_buf) и поведение обработчиков insert_edges и get_random_vertices из sw_kernel.
+    """
+
+    def __init__(self, seed: int | None = None):
+        self.dev_path = "fake-gpc"
+        self.handlers: dict[str, int] = {}
+
+        self._graph = CPUWrapper(VertexTable(), seed)  # граф на стороне "gpc"
+        self._edges: list[np.ndarray] = []
+        self._handler: str | None = None
+        self._arguments: list[int] = []  # значения, принятые текущим обработчиком
+        self._output = np.empty(0, dtype=np.uint64)  # очередь gpc -> хост
+        self._output_position = 0
+
+        self.sent_words = 0  # счетчики обмена через очереди
+        self.received_words = 0
+
+    def load_swk(self, sw_kernel_path: str) -> int:
+        return 0
+
+    def def_handlers(self, handlers_path: str):
+        self.handlers = {"insert_edges": 0, "get_random_vertices": 1}
+
+    def start_handler(self, name: str):
+        assert name in self.handlers, f"Unknown handler {name}"
+        self._handler = name
+        self._arguments = []
+
+    def mq_send_uint64(self, value: int):
+        self.sent_words += 1
+        self._arguments.append(int(value))
+        if self._handler == "get_random_vertices" and len(self._arguments) == 2:
+            self._random_vertices(*self._arguments)
+
+    def mq_send_buf(self, buffer):
+        assert self._handler == "insert_edges" and len(self._arguments) == 1
+        edges = np.frombuffer(buffer, dtype=np.uint64).reshape(-1, 3)
+        assert len(edges) == self._arguments[0], "Edge count does not match buffer size"
+        self.sent_words += edges.size
+
+        # Обработчик дополняет граф, поэтому повторная загрузка добавляет ребра к уже загруженным
+        self._edges.append(edges.copy())
+        self._graph.insert_graph(np.concatenate(self._edges))
+        return None
+
+    def join(self, thread):
+        pass
+
+    def mq_receive_uint64(self) -> int:
+        assert self._output_position < len(self._output), "Output queue is empty"
+        self.received_words += 1
+        self._output_position += 1
+        return int(self._output[self._output_position - 1])
+
+    def mq_receive_buf(self, buffer):
+        """ Заполнить буфер следующими словами очереди gpc -> хост """
+        words = np.frombuffer(buffer, dtype=np.uint64)
+        end = self._output_position + len(words)
+        assert end <= len(self._output), "Output queue is empty"
+        words[:] = self._output[self._output_position:end]
+        self.received_words += len(words)
+        self._output_position = end
+        return None
+
+    def _random_vertices(self, count: int, start_vertex: int):
+        walk = np.stack(self._graph.random_walks(1, count, start_vertex), axis=-1)[0]  # (count, 4): u, v, time, adj_c
+        self._output = walk.ravel()
+        self._output_position = 0
@@ -0,0 +1,131 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+EDGE_WIDTH = 3  # ребро - три uint64: from, to, atribute (формат буфера для gpc)
+
+
+def graph_key(tonality: str, L: int) -> str:
+    return f"{tonality}_l{L}"
+
+
+def as_edge_array(df: pd.DataFrame | np.ndarray) -> np.ndarray:
+    """ Ребра графа в виде массива (количество ребер, 3) uint64; массив из хранилища возвращается без копирования """
+    if isinstance(df, np.ndarray):
+        return df.reshape(-1, EDGE_WIDTH).astype(np.uint64, copy=False)
+    edges = np.empty((len(df), EDGE_WIDTH), dtype=np.uint64)
+    edges[:, 0] = df['from']
+    edges[:, 1] = df['to']
+    edges[:, 2] = df['atribute']
+    return edges
+
+
+class GraphStore:
+    """
+    Хранилище графов де Брюйна в шардах фиксированной ширины.
+
+    Ребра всех произведений одной тональности и L дописываются в файлы-шарды как записи из трех uint64
+    (from, to, atribute) - ровно в том виде, в котором они передаются в gpc, поэтому шард отображается
+    в память и отправляется без преобразований, а столбцы доступны как срезы без копирования.
+    Небольшой json-индекс хранит, в каком шарде и по какому смещению лежит каждое произведение.
+    """
+    INDEX_FILENAME = "graph_index.json"
+
+    def __init__(self, root: Path, shard_edges=1 << 26):
+        assert root.exists() and root.is_dir()
+
+        self.root = root
+        self.shard_edges = shard_edges  # максимальное количество ребер в одном шарде
+
+        # Индекс: graphs - (тональность, L) -> шарды -> произведения со смещением и количеством ребер;
+        #         pieces - произведение -> (граф, шард)
+        self.index = {'graphs': {}, 'pieces': {}}
+        try:
+            with open(self.root / self.INDEX_FILENAME) as file:
+                self.index = json.load(file)
+        except FileNotFoundError:
+            pass
+
+    def save_index(self):
+        """ Атомарная запись индекса (записанные, но не попавшие в индекс ребра просто не используются) """
+        tmp_path = self.root / (self.INDEX_FILENAME + ".tmp")
+        with open(tmp_path, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(tmp_path, self.root / self.INDEX_FILENAME)
+
+    def has_piece(self, name: str) -> bool:
+        return name in self.index['pieces']
+
+    def pieces(self, tonality: str, L: int) -> list[str]:
+        shards = self.index['graphs'].get(graph_key(tonality, L), {})
+        return [name for pieces in shards.values() for name in pieces]
+
+    def graphs(self) -> list[str]:
+        return list(self.index['graphs'])
+
+    def write_piece(self, name: str, tonality: str, L: int, df: pd.DataFrame):
+        """ Дописать ребра произведения в текущий шард графа (tonality, L) """
+        if self.has_piece(name):
+            self.remove_piece(name)
+
+        edges = as_edge_array(df)
+
+        key = graph_key(tonality, L)
+        shards = self.index['graphs'].setdefault(key, {})
+        shard_name = self._current_shard(key, shards, len(edges))
+        with open(self.root / shard_name, 'ab') as file:
+            offset = file.tell() // (EDGE_WIDTH * 8)
+            file.write(edges.tobytes())
+
+        shards[shard_name][name] = [offset, len(edges)]
+        self.index['pieces'][name] = [key, shard_name]
+
+    def remove_piece(self, name: str):
+        """ Удалить произведение из индекса (место в шарде не освобождается) """
+        key, shard_name = self.index['pieces'].pop(name)
+        del self.index['graphs'][key][shard_name][name]
+
+    def _current_shard(self, key: str, shards: dict, edge_count: int) -> str:
+        if shards:
+            shard_name = list(shards)[-1]
+            shard_path = self.root / shard_name
+            shard_edges = shard_path.stat().st_size // (EDGE_WIDTH * 8) if shard_path.exists() else 0
+            if shard_edges == 0 or shard_edges + edge_count <= self.shard_edges:
+                return shard_name
+        shard_name = f"{key}_{len(shards):04d}.edges"
+        shards[shard_name] = {}
+        return shard_name
+
+    def load_edges(self, tonality: str, L: int) -> np.ndarray:
+        """
+        Все ребра графа (tonality, L) в виде массива (количество ребер, 3) uint64.
+        Если граф лежит в одном шарде без удаленных произведений, возвращается отображение файла без копирования
+        """
+        parts = []
+        for shard_name, pieces in self.index['graphs'].get(graph_key(tonality, L), {}).items():
+            if not pieces:
+                continue
+            shard = np.memmap(self.root / shard_name, dtype=np.uint64, mode='r').reshape(-1, EDGE_WIDTH)
+
+            # Объединяем соседние произведения в непрерывные диапазоны
+            ranges = []
+            for offset, count in sorted(pieces.values()):
+                if ranges and ranges[-1][1] == offset:
+                    ranges[-1][1] = offset + count
+                else:
+                    ranges.append([offset, offset + count])
+            parts.extend(shard[start:end] for start, end in ranges)
+
+        if not parts:
+            return np.empty((0, EDGE_WIDTH), dtype=np.uint64)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def load(self, tonality: str, L: int) -> pd.DataFrame:
+        """ Граф (tonality, L) в виде DataFrame {"from", "to", "atribute"} """
+        edges = self.load_edges(tonality, L)
+        return pd.DataFrame({'from': edges[:, 0], 'to': edges[:, 1], 'atribute': edges[:, 2]})
@@ -0,0 +1,77 @@
+import time
+from typing import Iterable, NamedTuple
+
+import numpy as np
+from mido import MidiFile, Message, UnknownMetaMessage
+
+from . import metrics
+
+NOTE_COUNT = 128  # номера нот midi
+
+
+class Instrument(NamedTuple):
+    name: str
+    program: int  # номер инструмента midi (program_change), с 0
+    low: int  # нижняя граница диапазона нот (включительно)
+    high: int  # верхняя граница диапазона нот (включительно)
+
+
+class InstrumentsTable:
+    """
+    Таблица инструментов: каждый инструмент играет ноты своего диапазона, диапазоны могут пересекаться.
+    Для каждой из 128 нот заранее вычислен список инструментов, поэтому распределение нот - один проход по событиям
+    """
+
+    def __init__(self, instruments: Iterable[tuple[str, int, int, int]]):
+        self.instruments = [Instrument(str(name), int(program), int(low), int(high))
+                            for name, program, low, high in instruments]
+
+        # нота -> номера инструментов, в диапазон которых она попадает
+        self.note_instruments: list[tuple[int, ...]] = [
+            tuple(i for i, instrument in enumerate(self.instruments) if instrument.low <= note <= instrument.high)
+            for note in range(NOTE_COUNT)
+        ]
+
+    @classmethod
+    def from_matrix(cls, matrix: np.matrix) -> 'InstrumentsTable':
+        """ Таблица из матрицы [["Название инструмента", "Номер канала", "Нижняя граница", "Верхняя граница"], ...] """
+        return cls(tuple(row) for row in np.asarray(matrix).tolist())
+
+    def __len__(self):
+        return len(self.instruments)
+
+    def apply(self, input_mid: MidiFile) -> MidiFile:
+        """ Распределение нот midi по трекам инструментов """
+        start = time.perf_counter()
+        result_mid = MidiFile()
+        result_mid.ticks_per_beat = 120
+        result_mid.type = 1
+        for i, instrument in enumerate(self.instruments):
+            result_mid.add_track(instrument.name)
+            # Set the instrument
+            result_mid.tracks[i].append(Message('control_change', control=0, value=0x00, channel=i, time=0))
+            result_mid.tracks[i].append(Message('control_change', control=32, value=0x00, channel=i, time=0))
+            result_mid.tracks[i].append(Message('program_change', program=instrument.program, channel=i, time=0))  # MIDI file contain instruments from #0
+        tracks = result_mid.tracks
+        service_messages = len(tracks[0]) + 1 if tracks else 0  # название, инструмент и конец трека
+
+        # используем время для отсчета событий
+        last_event_time = [0] * len(self.instruments)  # начальное время инструмента = 0
+        global_time = 0  # Время нарастающим итогом для отсчета интервалов
+
+        # Делим единый трек на инструменты
+        for track in input_mid.tracks:
+            for msg in track:
+                global_time += msg.time
+                if msg.type in ("note_on", "note_off"):
+                    for i in self.note_instruments[msg.note]:
+                        tracks[i].append(Message(msg.type, channel=i, note=msg.note, velocity=msg.velocity, time=global_time - last_event_time[i]))
+                        last_event_time[i] = global_time
+
+        for track in tracks:
+            track.append(UnknownMetaMessage(type_byte=123, time=0))  # MetaMessage('end_of_track')
+
+        metrics.event('instruments.apply', instruments=[instrument.name for instrument in self.instruments],
+                      events=[len(track) - service_messages for track in tracks], seconds=round(time.perf_counter() - start, 6))
+
+        return result_mid
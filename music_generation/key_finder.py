@@ -0,0 +1,89 @@
+from pathlib import Path
+
+import numpy as np
+from mido import MidiFile
+
+from .midi_events import NOTE_ON, MidiEvents, decode_midi
+
+# Профили Темперли-Костки-Пейна для мажора и минора (как в music21.analysis.discrete.TemperleyKostkaPayne)
+MAJOR_PROFILE = np.array([0.748, 0.060, 0.488, 0.082, 0.670, 0.460, 0.096, 0.715, 0.104, 0.366, 0.057, 0.400])
+MINOR_PROFILE = np.array([0.712, 0.084, 0.474, 0.618, 0.049, 0.460, 0.105, 0.747, 0.404, 0.067, 0.133, 0.330])
+
+# Названия тоник в написании music21 (для мажора G# заменяется на A-, как в music21)
+MAJOR_TONICS = ("C", "C#", "D", "E-", "E", "F", "F#", "G", "A-", "A", "B-", "B")
+MINOR_TONICS = ("C", "C#", "D", "E-", "E", "F", "F#", "G", "G#", "A", "B-", "B")
+
+PERCUSSION_CHANNEL = 9  # 10 канал по стандарту MIDI (в mido каналы нумеруются с 0)
+
+
+def _rotated_profiles(profile: np.ndarray) -> np.ndarray:
+    """ Матрица (тоника, класс высоты): профиль, сдвинутый на каждую из 12 тоник """
+    pitch_classes = np.arange(12)
+    return profile[(pitch_classes[None, :] - pitch_classes[:, None]) % 12]
+
+
+_PROFILES = np.concatenate([_rotated_profiles(MAJOR_PROFILE), _rotated_profiles(MINOR_PROFILE)])  # 24 тональности
+_CENTERED_PROFILES = _PROFILES - _PROFILES.mean(axis=1, keepdims=True)
+
+
+def pitch_class_histogram(midi: MidiEvents | MidiFile) -> np.ndarray:
+    """
+    Суммарная длительность нот каждого класса высоты (в четвертях) по всем трекам, кроме перкуссии
+
+    :param midi: Нотные события midi-файла (или загруженный midi-файл)
+    :return: Массив из 12 длительностей
+    """
+    if isinstance(midi, MidiFile):
+        midi = decode_midi(midi)
+    events = midi.events[midi.events['channel'] != PERCUSSION_CHANNEL]
+
+    # События каждой клавиши (трек, канал, нота) подряд, в порядке времени
+    events = events[np.lexsort((events['note'], events['channel'], events['track']))]
+    is_on = (events['type'] == NOTE_ON) & (events['velocity'] > 0)
+    key_start = np.ones(len(events), dtype=bool)
+    key_start[1:] = ((events['track'][1:] != events['track'][:-1]) | (events['channel'][1:] != events['channel'][:-1])
+                     | (events['note'][1:] != events['note'][:-1]))
+
+    # Клавиша нажата после note_on и отпущена после note_off: повторные нажатия и отпускания не меняют состояния
+    was_on = np.zeros(len(events), dtype=bool)
+    was_on[1:] = is_on[:-1]
+    was_on[key_start] = False
+    changes = np.flatnonzero(is_on != was_on)  # нажатия и отпускания чередуются, начиная с нажатия
+    releases = np.flatnonzero(~is_on[changes])
+    note_off, note_on = changes[releases], changes[releases - 1]
+
+    durations = (events['tick'][note_off] - events['tick'][note_on]).astype(np.float64)
+    return np.bincount(events['note'][note_off] % 12, weights=durations, minlength=12) / midi.ticks_per_beat
+
+
+def correlations(histogram: np.ndarray) -> np.ndarray:
+    """ Коэффициенты корреляции Пирсона гистограммы с профилями 24 тональностей (12 мажорных, затем 12 минорных) """
+    centered = histogram - histogram.mean()
+    denominator = np.sqrt((_CENTERED_PROFILES ** 2).sum(axis=1) * (centered ** 2).sum())
+    if denominator[0] == 0:
+        return np.zeros(len(_PROFILES))
+    return _CENTERED_PROFILES @ centered / denominator
+
+
+def find_key(histogram: np.ndarray) -> tuple[str, str]:
+    """
+    Тональность по гистограмме классов высот (алгоритм Крумханзла-Шмуклера с профилями Темперли-Костки-Пейна)
+
+    :return: Тоника и лад, например ("E-", "major")
+    """
+    if not histogram.any():
+        raise ValueError("No notes to find the key")
+    coefficients = correlations(histogram).tolist()
+    # При равных коэффициентах music21 выбирает большую тонику и минор
+    best = max(range(24), key=lambda index: (coefficients[index], index % 12, index // 12))
+    if best < 12:
+        return MAJOR_TONICS[best], "major"
+    return MINOR_TONICS[best - 12], "minor"
+
+
+def music21_key(mid_filepath: Path) -> tuple[str, str]:
+    """ Тональность, найденная music21 по полному разбору файла (для проверки find_key) """
+    from music21.converter import parse as music21_parse
+
+    key = music21_parse(mid_filepath).analyze('TemperleyKostkaPayne')
+    return key.tonic.name, key.mode
@@ -0,0 +1,132 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Iterator, TextIO
+
+
+class NullCollector:
+    """ Сборщик по умолчанию: события не формируются и не записываются """
+    enabled = False
+
+    def record(self, event: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryCollector:
+    """ События в памяти процесса (для notebook и замеров) """
+    enabled = True
+
+    def __init__(self):
+        self.events: list[dict] = []
+        self._lock = Lock()
+
+    def record(self, event: dict):
+        with self._lock:
+            self.events.append(event)
+
+    def close(self):
+        pass
+
+    def select(self, name: str) -> list[dict]:
+        return [event for event in self.events if event['event'] == name]
+
+    def durations(self) -> dict[str, float]:
+        """ Суммарное время по видам событий, по убыванию - самый долгий этап первым """
+        totals = defaultdict(float)
+        for event in self.events:
+            if 'seconds' in event:
+                totals[event['event']] += event['seconds']
+        return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+
+class JsonLinesCollector:
+    """ Каждое событие - строка json в файле или потоке (например, sys.stdout) """
+    enabled = True
+
+    def __init__(self, output: Path | TextIO):
+        # Файл открывается на дозапись: строки из нескольких процессов не перезаписывают друг друга
+        self._own_file = isinstance(output, (str, Path))
+        self._file = open(output, 'a', encoding='utf-8') if self._own_file else output
+        self._lock = Lock()
+
+    def record(self, event: dict):
+        line = json.dumps(event, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        if self._own_file:
+            self._file.close()
+
+
+Collector = NullCollector | MemoryCollector | JsonLinesCollector
+
+_collector: Collector = NullCollector()
+
+
+def get_collector() -> Collector:
+    return _collector
+
+
+def set_collector(collector: Collector | None) -> Collector:
+    """
+    Включение сбора событий для всех этапов
+
+    :param collector: Новый сборщик (None - отключить сбор)
+    :return: Предыдущий сборщик
+    """
+    global _collector
+    previous, _collector = _collector, collector or NullCollector()
+    return previous
+
+
+def enabled() -> bool:
+    return _collector.enabled
+
+
+def event(name: str, **fields):
+    """ Событие name с полями fields (при отключенном сборе ничего не делает) """
+    if _collector.enabled:
+        _collector.record({'event': name, 'time': time.time(), **fields})
+
+
+@contextmanager
+def timer(name: str, **fields) -> Iterator[dict]:
+    """
+    Замер длительности блока: по выходу записывается событие name с полем seconds.
+    В возвращаемый словарь полей можно дописывать результаты этапа (количество ребер и т.п.)
+    """
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as error:
+        fields['failed'] = f"{type(error).__name__} – {error}"
+        raise
+    finally:
+        if _collector.enabled:
+            event(name, seconds=round(time.perf_counter() - start, 6), **fields)
+
+
+@contextmanager
+def capture() -> Iterator[MemoryCollector]:
+    """ Временный сбор событий в память (в процессе-воркере - чтобы передать их родителю вместе с результатом) """
+    collector = MemoryCollector()
+    previous = set_collector(collector)
+    try:
+        yield collector
+    finally:
+        set_collector(previous)
+
+
+def replay(events: list[dict]):
+    """ Запись событий, собранных в другом процессе """
+    if _collector.enabled:
+        for recorded_event in events:
+            _collector.record(recorded_event)
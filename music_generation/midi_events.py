@@ -0,0 +1,64 @@
+from typing import NamedTuple
+
+import numpy as np
+from mido import MidiFile
+
+NOTE_OFF = 0
+NOTE_ON = 1
+
+TEMPO_DEFAULT = 500_000  # микросекунд на четверть по стандарту, далее уточняется в треке через сообщение set_tempo
+
+# Нотное событие midi-файла
+EVENT_DTYPE = np.dtype([
+    ('track', np.uint16),  # номер трека
+    ('tick', np.uint64),  # время от начала трека в тиках (с учетом всех сообщений трека)
+    ('delta', np.uint32),  # время от предыдущего сообщения трека в тиках (поле time сообщения)
+    ('tempo', np.uint32),  # темп, установленный к этому моменту в этом же треке
+    ('type', np.uint8),  # NOTE_ON или NOTE_OFF как в сообщении (note_on с velocity=0 не преобразуется)
+    ('note', np.uint8),
+    ('velocity', np.uint8),
+    ('channel', np.uint8),
+])
+
+
+class MidiEvents(NamedTuple):
+    """ Нотные события midi-файла в одном структурированном массиве - общий вход всех этапов разбора """
+    events: np.ndarray  # массив EVENT_DTYPE, события упорядочены по трекам, внутри трека - как в файле
+    track_names: list[str]
+    ticks_per_beat: int
+    type: int  # тип midi-файла
+
+    def track_bounds(self) -> list[tuple[int, int]]:
+        """ Диапазоны строк массива событий по трекам (треки без нот не включаются) """
+        tracks = self.events['track']
+        if len(tracks) == 0:
+            return []
+        starts = np.flatnonzero(np.concatenate(([True], tracks[1:] != tracks[:-1])))
+        ends = np.append(starts[1:], len(tracks))
+        return list(zip(starts.tolist(), ends.tolist()))
+
+
+def decode_midi(mid: MidiFile) -> MidiEvents:
+    """
+    Однократное декодирование midi-файла: нотные события всех треков
+
+    :param mid: Загруженный midi-файл
+    """
+    rows = []
+    for track_index, track in enumerate(mid.tracks):
+        tick = 0
+        tempo = TEMPO_DEFAULT
+        for message in track:
+            tick += message.time
+            if message.type == "set_tempo":
+                tempo = message.tempo
+            elif message.type in ("note_on", "note_off"):
+                rows.append((track_index, tick, message.time, tempo, NOTE_ON if message.type == "note_on" else NOTE_OFF,
+                             message.note, message.velocity, message.channel))
+
+    return MidiEvents(
+        events=np.array(rows, dtype=EVENT_DTYPE),
+        track_names=[track.name for track in mid.tracks],
+        ticks_per_beat=mid.ticks_per_beat,
+        type=mid.type,
+    )
@@ -0,0 +1,203 @@
+import heapq
+import sys
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+from mido import MidiFile, Message
+
+from . import metrics
+from .vertex_table import VertexTable
+
+
+class MidiGenerator(ABC):
+    """
+    Генерация midi случайным обходом графа де Брюйна.
+    Наследники реализуют загрузку графа и выдачу ребер обхода (на gpc или на cpu)
+    """
+
+    def __init__(self, vertex_table: VertexTable, debug=False):
+        # Словарь вершин графа: номер вершины | окно аккордов
+        self.vertex_table = vertex_table
+
+        self.debug = debug
+
+        # Таблица декодирования: номер вершины -> (ноты, которые выключаются, ноты, которые включаются) при переходе
+        # от предыдущего аккорда окна к текущему. Зависит только от словаря вершин, поэтому сохраняется между графами
+        self.decode_table: dict[int, tuple[tuple[int, ...], tuple[int, ...]]] = {}
+
+        self.edges_count = 0
+        self.voice_count = 0
+
+    def init(self):
+        self.edges_count = 0
+        self.voice_count = 0
+
+    @abstractmethod
+    def insert_graph(self, df: pd.DataFrame | np.ndarray):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _decode_vertices(self, from_vertices: np.ndarray):
+        """
+        Заполнение таблицы декодирования для начальных вершин ребер загружаемого графа
+
+        :param from_vertices: Столбец начальных вершин ребер
+        """
+        if len(from_vertices) == 0:
+            return
+        seen = np.zeros(int(from_vertices.max()) + 1, dtype=bool)
+        seen[from_vertices] = True
+        seen[VertexTable.TERMINATOR_ID] = False
+
+        chord_diffs = {}  # у разных вершин часто одинаковая пара (предыдущий, текущий) аккорд
+        for vertex_id in np.flatnonzero(seen).tolist():
+            if vertex_id in self.decode_table or vertex_id >= len(self.vertex_table):
+                continue
+            chord_pair = self.vertex_table.vertices[vertex_id][-2:]
+            diff = chord_diffs.get(chord_pair)
+            if diff is None:
+                diff = chord_diffs[chord_pair] = self._chord_diff(*chord_pair)
+            self.decode_table[vertex_id] = diff
+
+    def _chord_diff(self, prev_chord_id: int, current_chord_id: int) -> tuple[tuple[int, ...], tuple[int, ...]]:
+        """
+        Ноты предыдущего аккорда, которых нет в текущем, и ноты текущего, которых нет в предыдущем.
+        Ноты идут от последней к первой, как при разборе кода вершины младшими байтами вперед: от порядка зависят
+        назначение голосов и порядок событий одного момента времени
+        """
+        prev_chord = self.vertex_table.chords[prev_chord_id]
+        current_chord = self.vertex_table.chords[current_chord_id]
+        notes_off = tuple(msg for msg in reversed(prev_chord) if msg not in current_chord)
+        notes_on = tuple(msg for msg in reversed(current_chord) if msg not in prev_chord)
+        return notes_off, notes_on
+
+    @abstractmethod
+    def _start_random_traversal(self, count, start_vertex):
+        """ Функция обхода графа по случайному пути """
+        raise NotImplementedError
+
+    @abstractmethod
+    def _get_random_edge(self) -> tuple[int, int, int, int]:
+        """ Очередное ребро обхода: (из вершины, в вершину, время, количество ребер из вершины) """
+        raise NotImplementedError
+
+    def _traversal_metrics(self) -> dict:
+        """ Показатели обхода для событий генерации (например, обращения к очереди gpc) """
+        return {}
+
+    def _get_free_voice(self, free_voices: list[int], mono_mid: list[MidiFile], max_voice_count) -> int:
+        """ Свободный голос с минимальным номером; дорожка голоса создается при первом использовании """
+        if free_voices:
+            return heapq.heappop(free_voices)
+        if len(mono_mid) >= max_voice_count:
+            raise IndexError(f"All {max_voice_count} voices are busy")
+
+        voice_mid = MidiFile()
+        voice_mid.ticks_per_beat = 120
+        voice_mid.type = 1
+        voice_mid.add_track('Acoustic Guitar')
+        mono_mid.append(voice_mid)
+        self.voice_count = len(mono_mid)
+        return len(mono_mid) - 1
+
+    def generate_midi(self, chord_count, max_voice_count):
+        # Счетчики относятся к одной генерации - граф может использоваться для многих генераций подряд
+        self.edges_count = 0
+        self.voice_count = 0
+        start = time.perf_counter()
+
+        # Начать обход графа
+        self._start_random_traversal(chord_count, VertexTable.TERMINATOR_ID)
+
+        # Создаем новые миди
+        origin_mid = MidiFile()
+        origin_mid.ticks_per_beat = 120
+        origin_mid.type = 1
+        origin_mid.add_track('Acoustic Guitar')
+        origin_track = origin_mid.tracks[0]
+        mono_mid = []  # массив одноголосных миди (только для использованных голосов)
+        chord = {}  # словарь нот аккорда в формате нота:голос для разделения на много одноголосных партий
+        # Время последнего события в голосе: задержка голоса отсчитывается от его событий и вычисляется только при записи в голос
+        last_event_time = []
+        # Куча освободившихся голосов (минимальный номер - первым)
+        free_voices = []
+        cur_chord_delay = 0  # Время, для измерения длительности предыдущего аккорда надо сохранить
+        prev_chord_delay = 0  # Время, для измерения длительности текущего аккорда
+        global_time = 0  # Время нарастающим итогом для отсчета интервалов
+        delay_for_origin = 0  # Время для оригинальной композиции
+
+        for chord_number in range(chord_count):  # Возьмем много аккордов
+            # Получим очередное ребро из gpc
+            from_vertex, to_vertex, edge_atr, adjacency_list_count = self._get_random_edge()
+            if self.debug:
+                print(from_vertex, to_vertex, edge_atr, adjacency_list_count)
+
+            if from_vertex >= len(self.vertex_table):
+                print("From_chord: В словаре нет информации о вершине c кодом " + str(from_vertex))
+                sys.exit()
+
+            if to_vertex >= len(self.vertex_table):
+                print("From_chord: В словаре нет информации о вершине c кодом " + str(to_vertex))
+                sys.exit()
+
+            if from_vertex != VertexTable.TERMINATOR_ID:
+                if self.debug:
+                    print(self.vertex_table.window(from_vertex))
+                # окно вершины: последний аккорд - текущий, перед ним - предыдущий; разница аккордов вычислена при загрузке графа
+                chord_diff = self.decode_table.get(from_vertex)
+                if chord_diff is None:
+                    chord_diff = self.decode_table[from_vertex] = self._chord_diff(*self.vertex_table.vertices[from_vertex][-2:])
+                notes_off, notes_on = chord_diff
+
+                self.edges_count += adjacency_list_count
+                global_time += prev_chord_delay  # текущий момент времени от начала пьесы
+                delay_for_origin = prev_chord_delay
+                if to_vertex == VertexTable.TERMINATOR_ID or chord_number == chord_count - 1:
+                    # прекратить звучание всех аккордов
+                    for msg, voice in chord.items():
+                        origin_track.append(Message('note_off', channel=0, note=msg, velocity=72, time=delay_for_origin))
+                        # Завершаем всех одновременно, а не в соответствии с задержкой голоса
+                        mono_mid[voice].tracks[0].append(Message('note_off', channel=0, note=msg, velocity=72, time=global_time - last_event_time[voice]))
+                        heapq.heappush(free_voices, voice)
+                        last_event_time[voice] = global_time  # время последнего событие для голоса используется для следующей задержки (см. маны и доки по MIDI :)
+                        delay_for_origin = 0
+                    chord = {}
+                else:
+                    # Нота, которая еще звучит, перед повторным включением тоже выключается - иначе ее голос не освободится
+                    for msg in notes_off + tuple(msg for msg in notes_on if msg in chord):
+                        if msg in chord:
+                            voice = chord.pop(msg)  # удаляем сразу: нота может быть только в одном голосе
+                            origin_track.append(Message('note_off', channel=0, note=msg, velocity=72, time=delay_for_origin))
+                            mono_mid[voice].tracks[0].append(Message('note_off', channel=0, note=msg, velocity=72, time=global_time - last_event_time[voice]))
+                            heapq.heappush(free_voices, voice)
+                            delay_for_origin = 0
+                            last_event_time[voice] = global_time  # время последнего событие для голоса используется для следующей задержки
+                    for msg in notes_on:
+                        voice = chord[msg] = self._get_free_voice(free_voices, mono_mid, max_voice_count)
+                        if voice == len(last_event_time):
+                            last_event_time.append(0)  # начальное время голоса = 0
+                        origin_track.append(Message('note_on', channel=0, note=msg, velocity=72, time=delay_for_origin))
+                        mono_mid[voice].tracks[0].append(Message('note_on', channel=0, note=msg, velocity=72, time=global_time - last_event_time[voice]))
+                        last_event_time[voice] = global_time  # время последнего событие для голоса используется для следующей задержки
+
+            prev_chord_delay = cur_chord_delay  # текужий аккорд становится предыдущим, сохраним время его звучания
+            cur_chord_delay = edge_atr  # сохраним время действия текущего аккорда
+
+        # edges_count / chord_count - среднее количество вариантов продолжения: показатель разнообразия обхода
+        metrics.event('generator.generate', backend=type(self).__name__, seconds=round(time.perf_counter() - start, 6),
+                      chords=chord_count, edges_count=self.edges_count, voices=self.voice_count,
+                      branching=self.edges_count / chord_count if chord_count else 0.0, **self._traversal_metrics())
+        return self.edges_count, origin_mid, mono_mid, self.voice_count
+
+    def run(self, df: pd.DataFrame | np.ndarray, chord_count, max_voice_count):
+        """ init, insert, generate and delete """
+        self.init()
+        self.insert_graph(df)
+        result = self.generate_midi(chord_count, max_voice_count)
+        self.close()
+
+        return result
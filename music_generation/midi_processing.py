@@ -1,15 +1,29 @@
-import binascii
+import contextlib
 import fnmatch
+import hashlib
 import os
 import pickle
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from pathlib import Path
 from threading import Condition, Thread
 
 import pandas as pd
-from music21.converter import parse as music21_parse
+from mido import MidiFile
 
+from . import metrics
 from .chord_processing import ChordProcessor
+from .graph_store import GraphStore
+from .key_finder import find_key, music21_key, pitch_class_histogram
+from .midi_events import decode_midi
+from .vertex_store import VertexStore
+from .vertex_table import VertexTable
+
+
+MANIFEST_FILENAME = "manifest.pcl"  # манифест обработанных файлов в папке с результатами
+
+# Словарь вершин процесса-воркера (открывается один раз на процесс)
+_worker_vertex_store: VertexStore | None = None
 
 
 def get_filtered_files(folder_path: Path, pattern: str) -> list[Path]:
@@ -19,31 +33,201 @@ def get_filtered_files(folder_path: Path, pattern: str) -> list[Path]:
     return result
 
 
+def file_content_hash(filepath: Path) -> str:
+    with open(filepath, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def convert_midi_file(chord_processor: ChordProcessor, mid_filepath: Path, result_dir: Path,
+                      verify_key=False, write_merged_midi=True) -> tuple[str, str, pd.DataFrame, VertexTable]:
+    """
+    Разбор одного midi-файла без обращения к общему словарю вершин (может выполняться в отдельном процессе)
+
+    :param chord_processor: Настроенный обработчик аккордов
+    :param mid_filepath: Исходный midi-файл
+    :param result_dir: Папка с результатами
+    :param verify_key: Сверить тональность с анализом music21 (полный разбор файла, медленно); при расхождении берется music21
+    :param write_merged_midi: Сохранить объединенный midi с аккордами в папку с результатами (для контроля)
+    :return: Имя произведения в хранилище графов, тональность, граф де Брюйна и локальная таблица вершин, в номерах которой записан граф
+    """
+    df = pd.DataFrame(columns=['from', 'to', 'atribute'])
+    vertex_table = VertexTable(chord_processor.terminator)
+
+    # Декодируем файл один раз: нотные события используются и для графа, и для тональности
+    with metrics.timer('midi.parse', file=str(mid_filepath)) as fields:
+        midi = decode_midi(MidiFile(mid_filepath, clip=True))
+        fields['events'] = len(midi.events)
+
+    # Мерджим трек и разбираем последовательность аккордов в пакеты для графа деБрюйна
+    merged_path = result_dir / mid_filepath.name if write_merged_midi else None
+    df = chord_processor.merge_tracks(df, midi, merged_path, vertex_table)
+
+    # определяем тональность по уже декодированным нотам и добавляем к имени файлв
+    with metrics.timer('midi.key', file=str(mid_filepath)) as fields:
+        tonic, mode = find_key(pitch_class_histogram(midi))
+        if verify_key:
+            expected_tonic, expected_mode = music21_key(mid_filepath)
+            if (tonic, mode) != (expected_tonic, expected_mode):
+                print(f"Тональность {mid_filepath}: {tonic} {mode}, music21: {expected_tonic} {expected_mode}")
+                tonic, mode = expected_tonic, expected_mode
+        fields['tonality'] = f"{tonic}_{mode}"
+
+    tonality = f"{tonic}_{mode}"
+    piece_name = Path(mid_filepath).stem + f"_{tonality}.l{chord_processor.L}"
+    return piece_name, tonality, df, vertex_table
+
+
+def store_vertices(vertex_store: VertexStore, df: pd.DataFrame, vertex_table: VertexTable):
+    """ Запись вершин файла в общий словарь (одной транзакцией) и перекодировка графа файла в номера словаря """
+    with metrics.timer('midi.vertices', vertices=len(vertex_table)):
+        remap = vertex_store.merge(vertex_table)
+        df['from'] = remap[df['from'].to_numpy()]
+        df['to'] = remap[df['to'].to_numpy()]
+
+
+def _convert_chunk(chord_processor: ChordProcessor, vertex_store_path: Path, chunk: list[tuple[int, Path]], result_dir: Path,
+                   verify_key=False, write_merged_midi=True, collect_metrics=False) -> tuple[list[tuple], list[dict]]:
+    """
+    Обработка пачки файлов в процессе-воркере: вершины записываются в словарь прямо из воркера,
+    родителю возвращаются графы в номерах словаря. Ошибки возвращаются родителю вместо результата
+
+    :param collect_metrics: Собрать события этапов и вернуть их родителю (сборщик родителя в воркере недоступен)
+    :return: Результаты по файлам и события этапов
+    """
+    global _worker_vertex_store
+    if _worker_vertex_store is None or _worker_vertex_store.path != vertex_store_path:
+        _worker_vertex_store = VertexStore(vertex_store_path, chord_processor.terminator)
+
+    results = []
+    with metrics.capture() if collect_metrics else contextlib.nullcontext() as collector:
+        for file_num, mid_filepath in chunk:
+            try:
+                piece_name, tonality, df, vertex_table = convert_midi_file(chord_processor, mid_filepath, result_dir,
+                                                                           verify_key, write_merged_midi)
+                store_vertices(_worker_vertex_store, df, vertex_table)
+                results.append((file_num, mid_filepath, piece_name, tonality, df, None))
+            except (Exception, SystemExit) as error:  # merge_tracks завершает работу через sys.exit для midi type 2
+                results.append((file_num, mid_filepath, None, None, None, f"{type(error).__name__} – {error}"))
+    return results, collector.events if collector is not None else []
+
+
 class MidiProcessor:
-    def __init__(self, chord_processor: ChordProcessor, vertex_dictionary_file: Path, maximum_threads=20):
+    def __init__(self, chord_processor: ChordProcessor, vertex_dictionary_file: Path, maximum_threads=20,
+                 maximum_processes: int | None = None, chunk_size=16, verify_key=False, write_merged_midi=True,
+                 checkpoint_files=1000):
+        """
+        :param vertex_dictionary_file: Словарь вершин (база SQLite, см. VertexStore)
+        :param checkpoint_files: Через сколько записанных файлов сохранять индекс хранилища графов и манифест
+        """
         self.chord_processor = chord_processor
+        self.verify_key = verify_key  # сверять найденную тональность с music21 (медленно)
+        self.write_merged_midi = write_merged_midi  # сохранять объединенные midi для контроля результатов
         self.maximum_threads = maximum_threads  # количество потоков обработки
-
-        self.vertex_dictionary = {str(binascii.crc32(str(chord_processor.terminator).encode('utf8'))): str(chord_processor.terminator)}
+        self.maximum_processes = maximum_processes or os.cpu_count() or 1  # количество процессов при use_processes=True
+        self.chunk_size = chunk_size  # количество файлов, отправляемых процессу за один раз
+        self.checkpoint_files = checkpoint_files
 
         # многопоточность ускоряет обработку файлов
         self.ack_signal = Condition()
         self.running_threads = 0  # разделяемая переменная для синхронизации потоков
 
-        # Словарь вершин графа в формате: индекс вершины, полученный как crc32 аккордов | код вершины
+        # Словарь вершин графа на диске: плотный номер вершины | окно аккордов. Вершины каждого файла фиксируются сразу,
+        # поэтому сбой посреди обработки не теряет словарь, а в памяти он не хранится
         self.vertex_dictionary_file = vertex_dictionary_file
-        try:
-            with open(vertex_dictionary_file, 'rb') as fp:
-                self.vertex_dictionary = pickle.load(fp)
-        except FileNotFoundError or pickle.PickleError:
-            print(f"Create dictionary file {vertex_dictionary_file}")
+        self.vertex_store = VertexStore(vertex_dictionary_file, chord_processor.terminator)
+        self._dictionary_created = self.vertex_store.created  # номера вершин в ранее записанных графах недействительны
+        if self._dictionary_created:
+            metrics.event('midi.dictionary_created', path=str(vertex_dictionary_file))
 
-    def process(self, midi_filepaths: list[Path], result_dir: Path):
+        # Манифест обработанных файлов: (путь к midi, параметры ChordProcessor) | (хэш содержимого, имя произведения в хранилище)
+        self.manifest: dict[tuple[str, tuple], tuple[str, str]] = {}
+        # Хэши содержимого по пути: (размер, время изменения, хэш) - чтобы не перечитывать неизменившиеся файлы
+        self.content_hash_cache: dict[str, tuple[int, int, str]] = {}
+        self._content_hashes: dict[Path, str] = {}  # хэши файлов текущей обработки
+        self.graph_store: GraphStore | None = None  # хранилище графов в папке с результатами
+        self._manifest_file: Path | None = None
+        self._stored_files = 0  # файлов, записанных после последнего сохранения индекса и манифеста
+
+    def process(self, midi_filepaths: list[Path], result_dir: Path, use_processes=False, incremental=True):
+        """
+        Обработка midi-файлов в графы де Брюйна
+
+        :param midi_filepaths: Исходные midi-файлы
+        :param result_dir: Папка для хранилища графов и объединенных midi
+        :param use_processes: Обрабатывать файлы пулом процессов (разбор midi упирается в GIL, потоки его не ускоряют)
+        :param incremental: Пропускать файлы, которые не изменились с прошлой обработки с теми же параметрами
+        """
         for midi_filepath in midi_filepaths:
             assert midi_filepath.exists()
 
         assert result_dir.exists() and result_dir.is_dir()
 
+        with metrics.timer('midi.process', files=len(midi_filepaths), use_processes=use_processes) as fields:
+            self.graph_store = GraphStore(result_dir)
+            self._manifest_file = result_dir / MANIFEST_FILENAME
+            self.manifest, self.content_hash_cache = self._load_manifest(self._manifest_file)
+            self._content_hashes = {midi_filepath: self._content_hash(midi_filepath) for midi_filepath in midi_filepaths}
+            if incremental and not self._dictionary_created:
+                midi_filepaths = [midi_filepath for midi_filepath in midi_filepaths if self._is_changed(midi_filepath)]
+            fields['changed'] = len(midi_filepaths)
+            vertex_count = len(self.vertex_store)
+
+            if use_processes:
+                self._process_in_pool(midi_filepaths, result_dir)
+            else:
+                self._process_in_threads(midi_filepaths, result_dir)
+            fields['new_vertices'] = len(self.vertex_store) - vertex_count
+
+            # Словарь вершин уже записан; сохраняем индекс хранилища и манифест
+            self._save_checkpoint()
+            self._dictionary_created = False
+
+    def _save_checkpoint(self):
+        """ Сохранение индекса хранилища графов и манифеста: после сбоя повторная обработка начнется с этого места """
+        with metrics.timer('midi.checkpoint', files=self._stored_files):
+            self.graph_store.save_index()
+            tmp_path = self._manifest_file.with_name(self._manifest_file.name + ".tmp")
+            with open(tmp_path, 'wb') as file:
+                pickle.dump({'files': self.manifest, 'hashes': self.content_hash_cache}, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._manifest_file)
+            self._stored_files = 0
+
+    @staticmethod
+    def _load_manifest(manifest_file: Path) -> tuple[dict, dict]:
+        try:
+            with open(manifest_file, 'rb') as file:
+                content = pickle.load(file)
+            return content['files'], content['hashes']
+        except (FileNotFoundError, pickle.PickleError, KeyError, TypeError):
+            return {}, {}
+
+    def _content_hash(self, midi_filepath: Path) -> str:
+        """ Хэш содержимого файла; файл перечитывается только если изменились его размер или время изменения """
+        stat = midi_filepath.stat()
+        cached = self.content_hash_cache.get(str(midi_filepath))
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        content_hash = file_content_hash(midi_filepath)
+        self.content_hash_cache[str(midi_filepath)] = (stat.st_size, stat.st_mtime_ns, content_hash)
+        return content_hash
+
+    def _is_changed(self, midi_filepath: Path) -> bool:
+        """ Файл нужно обработать, если с этими параметрами он не обрабатывался, его содержимое изменилось или результат удален """
+        entry = self.manifest.get((str(midi_filepath), self.chord_processor.parameters_key()))
+        if entry is None:
+            return True
+        content_hash, piece_name = entry
+        return content_hash != self._content_hashes[midi_filepath] or not self.graph_store.has_piece(piece_name)
+
+    def _update_manifest(self, mid_filepath: Path, piece_name: str):
+        manifest_key = (str(mid_filepath), self.chord_processor.parameters_key())
+        previous_entry = self.manifest.get(manifest_key)
+        if previous_entry is not None and previous_entry[1] != piece_name and self.graph_store.has_piece(previous_entry[1]):
+            # После изменения файла могла поменяться тональность - старый граф больше не актуален
+            self.graph_store.remove_piece(previous_entry[1])
+        self.manifest[manifest_key] = (self._content_hashes[mid_filepath], piece_name)
+
+    def _process_in_threads(self, midi_filepaths: list[Path], result_dir: Path):
         # Формируем потоки
         threads = []
         for index, midi_filepath in enumerate(midi_filepaths):
@@ -63,54 +247,61 @@ class MidiProcessor:
         for mid2graph_thread in threads:
             mid2graph_thread.join()
 
-        #Сохранение словаря
-        with open(self.vertex_dictionary_file, 'wb') as file:
-            pickle.dump(self.vertex_dictionary, file, protocol=pickle.HIGHEST_PROTOCOL)
+    def _process_in_pool(self, midi_filepaths: list[Path], result_dir: Path):
+        numbered_filepaths = list(enumerate(midi_filepaths))
+        chunks = (numbered_filepaths[i:i + self.chunk_size] for i in range(0, len(numbered_filepaths), self.chunk_size))
+        # Ограничиваем очередь заданий, чтобы результаты не копились в памяти родителя
+        maximum_pending = 2 * self.maximum_processes
 
-    def _get_unique_index(self, vertex) -> tuple:
-        """
-        Формирование словаря уникальных кодов вершин
-        """
+        with ProcessPoolExecutor(max_workers=self.maximum_processes) as executor:
+            pending: set[Future] = set()
+            for chunk in chunks:
+                if len(pending) >= maximum_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self._collect_chunks(done)
+                pending.add(executor.submit(_convert_chunk, self.chord_processor, self.vertex_dictionary_file, chunk,
+                                            result_dir, self.verify_key, self.write_merged_midi, metrics.enabled()))
 
-        crc32 = str(binascii.crc32(vertex.encode('utf8')))
-        if crc32 in self.vertex_dictionary.keys() and vertex != self.vertex_dictionary[crc32]:
-            return self._get_unique_index(vertex + " ")
-        return crc32, vertex
+            done, _ = wait(pending)
+            self._collect_chunks(done)
 
-    def _mid2graph(self, mid_filepath: Path, result_dir: Path, file_num: int):
-        try:
-            df = pd.DataFrame(columns=['from', 'to', 'from_crc32', 'to_crc32', 'atribute'])
-            print(f"Converting file #{file_num}: {mid_filepath}")
+    def _collect_chunks(self, futures: set[Future]):
+        """ Запись графов, полученных от воркеров, в хранилище (выполняется только в родительском процессе) """
+        for future in futures:
+            results, events = future.result()
+            metrics.replay(events)
+            for file_num, mid_filepath, piece_name, tonality, df, error in results:
+                if error is not None:
+                    print(f"Не удалось обработать файл {mid_filepath}", error)
+                    metrics.event('midi.failed', file=str(mid_filepath), error=error)
+                    continue
+                self._store_graph(mid_filepath, piece_name, tonality, df, file_num)
 
-            # Мерджим трек и разбираем последовательность аккордов в пакеты для графа деБрюйна
-            df = self.chord_processor.merge_tracks(df, mid_filepath, result_dir / mid_filepath.name)
+    def _store_graph(self, mid_filepath: Path, piece_name: str, tonality: str, df: pd.DataFrame, file_num: int):
+        """ Запись графа (уже в номерах словаря вершин) в хранилище и отметка в манифесте """
+        try:
+            with metrics.timer('midi.write', file_num=file_num, piece=piece_name, edges=len(df)):
+                self.graph_store.write_piece(piece_name, tonality, self.chord_processor.L, df)
+                self._update_manifest(mid_filepath, piece_name)
+            self._stored_files += 1
+            if self._stored_files >= self.checkpoint_files:
+                self._save_checkpoint()
+        except Exception as error:
+            print(f"Проблемы с формированием словаря и графа для {piece_name} {type(error).__name__}: {error}")
 
-            # определяем тональность и добавляем к имени файлв
-            score = music21_parse(mid_filepath)
-            key = score.analyze('TemperleyKostkaPayne')
+    def _mid2graph(self, mid_filepath: Path, result_dir: Path, file_num: int):
+        try:
+            piece_name, tonality, df, vertex_table = convert_midi_file(self.chord_processor, mid_filepath, result_dir,
+                                                                       self.verify_key, self.write_merged_midi)
+            # Словарь вершин сам упорядочивает писателей - под общей блокировкой остается только запись в хранилище графов
+            store_vertices(self.vertex_store, df, vertex_table)
 
-            pcl_out_filename = result_dir / (Path(mid_filepath).stem + f"_{key.tonic.name}_{key.mode}.pcl{self.chord_processor.L}")
-            # Вставка в общий словарь найденных аккордов
-            try:
-                self.ack_signal.acquire()
-                for index, row in df.iterrows():
-                    (from_vertex_crc32, from_vertex) = self._get_unique_index(row['from'])
-                    (to_vertex_crc32, to_vertex) = self._get_unique_index(row['to'])
-                    df.loc[index, 'from'] = from_vertex
-                    df.loc[index, 'to'] = to_vertex
-                    df.loc[index, 'from_crc32'] = from_vertex_crc32
-                    df.loc[index, 'to_crc32'] = to_vertex_crc32
-                    self.vertex_dictionary[to_vertex_crc32] = to_vertex
-                # Сохраняем в файл
-                print(f"Write to file #{file_num} : {pcl_out_filename}")
-                df.to_pickle(pcl_out_filename)
-            except Exception as error:
-                print(f"Проблемы с формированием dic и pcl файлов для {pcl_out_filename} {type(error).__name__}: {error}")
-            finally:
-                self.ack_signal.release()
+            with self.ack_signal:
+                self._store_graph(mid_filepath, piece_name, tonality, df, file_num)
         except Exception as error:
             print(f"Не удалось обработать файл {mid_filepath}", type(error).__name__, "–", error)
+            metrics.event('midi.failed', file=str(mid_filepath), error=f"{type(error).__name__} – {error}")
         finally:
             self.ack_signal.acquire()
             self.running_threads = self.running_threads - 1
-            self.ack_signal.release()
\ No newline at end of file
+            self.ack_signal.release()
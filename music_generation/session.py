@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from typing import Callable
+
+from .graph_store import GraphStore, graph_key
+from .midi_generator import MidiGenerator
+
+
+class GenerationSession:
+    """
+    Долгоживущая сессия генерации.
+
+    Для каждого графа (тональность, L) создается свой генератор: он один раз инициализируется (для gpc - захват
+    устройства, загрузка sw_kernel и обработчиков) и один раз получает граф, после чего обслуживает сколько угодно
+    генераций. Если графов больше, чем `max_graphs` (например, количество доступных gpc), или их суммарный размер
+    превышает `memory_budget`, закрывается генератор графа, который дольше всех не использовался.
+    """
+
+    def __init__(self, generator_factory: Callable[[], MidiGenerator], graph_store: GraphStore,
+                 memory_budget: int = 4 << 30, max_graphs: int | None = 1):
+        """
+        :param generator_factory: Создание нового генератора, например `lambda: GPCWrapper(...)` или `lambda: CPUWrapper(...)`
+        :param graph_store: Хранилище, из которого загружаются графы
+        :param memory_budget: Максимальный суммарный размер ребер загруженных графов в байтах
+        :param max_graphs: Максимальное количество одновременно загруженных графов (None - ограничивает только бюджет)
+        """
+        self.generator_factory = generator_factory
+        self.graph_store = graph_store
+        self.memory_budget = memory_budget
+        self.max_graphs = max_graphs
+
+        self.resident: OrderedDict[str, tuple[MidiGenerator, int]] = OrderedDict()  # граф -> (генератор, размер ребер)
+        self.loads = 0  # счетчики загрузок и вытеснений графов
+        self.evictions = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def generator(self, tonality: str, L: int) -> MidiGenerator:
+        """ Генератор с загруженным графом (tonality, L) """
+        key = graph_key(tonality, L)
+        if key in self.resident:
+            self.resident.move_to_end(key)
+            return self.resident[key][0]
+
+        edges = self.graph_store.load_edges(tonality, L)
+        assert len(edges) > 0, f"Graph {key} is empty"
+        self._evict(edges.nbytes)
+
+        generator = self.generator_factory()
+        generator.init()
+        generator.insert_graph(edges)
+        self.resident[key] = (generator, edges.nbytes)
+        self.loads += 1
+        return generator
+
+    def generate(self, tonality: str, L: int, chord_count, max_voice_count):
+        """ Генерация по графу (tonality, L); результат как у `MidiGenerator.run` """
+        return self.generator(tonality, L).generate_midi(chord_count, max_voice_count)
+
+    def generate_many(self, tonality: str, L: int, piece_count: int, chord_count, max_voice_count) -> list:
+        generator = self.generator(tonality, L)
+        return [generator.generate_midi(chord_count, max_voice_count) for _ in range(piece_count)]
+
+    def _evict(self, required_bytes: int):
+        """ Освободить место под новый граф, закрывая давно не использованные """
+        while self.resident and (
+                (self.max_graphs is not None and len(self.resident) >= self.max_graphs)
+                or self._resident_bytes() + required_bytes > self.memory_budget):
+            key, (generator, _) = self.resident.popitem(last=False)
+            generator.close()
+            self.evictions += 1
+
+    def _resident_bytes(self) -> int:
+        return sum(size for _, size in self.resident.values())
+
+    def close(self):
+        while self.resident:
+            _, (generator, _) = self.resident.popitem()
+            generator.close()
@@ -0,0 +1,90 @@
+import hashlib
+import io
+import os
+from pathlib import Path
+
+from mido import MidiFile
+
+
+def midi_content_hash(mid: MidiFile) -> str:
+    """ Хэш содержимого midi (события всех треков и ticks_per_beat) в том виде, в котором он сохраняется в файл """
+    buffer = io.BytesIO()
+    mid.save(file=buffer)
+    return hashlib.sha256(buffer.getvalue()).hexdigest()
+
+
+def path_content_hash(path: Path) -> str:
+    """ Хэш содержимого файла или всех файлов папки (с относительными путями) """
+    content_hash = hashlib.sha256()
+    files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+    for filepath in files:
+        content_hash.update(str(filepath.relative_to(path) if path.is_dir() else filepath.name).encode())
+        with open(filepath, 'rb') as file:
+            content_hash.update(file.read())
+    return content_hash.hexdigest()
+
+
+class StyleCache:
+    """
+    Кэш стилизованных голосов на диске: ключ - хэш содержимого голоса, стиля, конфигурации и параметров стилизации,
+    значение - стилизованный midi. Размер ограничен, при переполнении удаляются давно не использованные голоса (LRU);
+    время последнего использования - время изменения файла
+    """
+    SUFFIX = ".mid"
+
+    def __init__(self, root: Path, max_bytes=1 << 30):
+        root.mkdir(parents=True, exist_ok=True)
+
+        self.root = root
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._size = sum(entry.stat().st_size for entry in self.root.glob('*' + self.SUFFIX))
+
+    @staticmethod
+    def key(voice_mid: MidiFile, *parameters) -> str:
+        """
+        :param voice_mid: Голос до стилизации
+        :param parameters: Все, от чего зависит результат: хэши стиля и конфигурации, параметры стилизации
+        """
+        content_hash = hashlib.sha256(midi_content_hash(voice_mid).encode())
+        content_hash.update(repr(parameters).encode())
+        return content_hash.hexdigest()
+
+    def get(self, key: str) -> MidiFile | None:
+        path = self.root / (key + self.SUFFIX)
+        try:
+            mid = MidiFile(path)
+        except (FileNotFoundError, OSError, EOFError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)  # отметка использования для LRU
+        self.hits += 1
+        return mid
+
+    def put(self, key: str, mid: MidiFile):
+        path = self.root / (key + self.SUFFIX)
+        tmp_path = path.with_suffix('.tmp')
+        mid.save(tmp_path)
+        previous_size = path.stat().st_size if path.exists() else 0
+        os.replace(tmp_path, path)  # запись атомарна: параллельный читатель не увидит половину файла
+        self._size += path.stat().st_size - previous_size
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """ Удаление давно не использованных голосов, пока размер кэша больше допустимого """
+        entries = []
+        for entry in self.root.glob('*' + self.SUFFIX):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry))
+        entries.sort(key=lambda item: item[0])
+
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if self._size <= self.max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            self._size -= size
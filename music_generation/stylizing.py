@@ -1,95 +1,183 @@
 import sys
-from collections import defaultdict
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 from mido import MidiFile, Message, UnknownMetaMessage
 
+from . import metrics
+from .style_cache import StyleCache, path_content_hash
+from .track_merge import merge_streams, track_note_events, with_delta_times
+
+
+# Состояние процесса-воркера стилизации: Performer с загруженной конфигурацией и стиль (загружаются один раз)
+_worker_performer = None
+_worker_style = None
+
+
+def _import_performer(style_performer_path: Path):
+    sys.path.insert(0, f"{style_performer_path}/src")  # TODO: некостыльный динамичный import
+    from performance.performer import Performer
+    return Performer
+
+
+def _init_style_worker(style_performer_path: Path, midi_style: Path):
+    """ Инициализация процесса-воркера: конфигурация Performer компилируется и стиль загружается один раз на процесс """
+    global _worker_performer, _worker_style
+    _worker_performer = _import_performer(style_performer_path)()  # класс-фасад
+    _worker_performer.compile(f"{style_performer_path}/config/config_0025", 'config.json')  # загрузить конфигурацию
+    _worker_style = MidiFile(midi_style)
+
+
+def _style_voice(voice_mid: MidiFile, style_parameters: dict, timelimit: float) -> tuple[MidiFile, float]:
+    """ :return: Стилизованный голос и время стилизации в воркере (без ожидания в очереди пула) """
+    start = time.perf_counter()
+    styled = _worker_performer.style(voice_mid, _worker_style, **style_parameters, verbose=1, timelimit=timelimit)  # стилизация
+    return styled, time.perf_counter() - start
+
+
+def voice_time_limits(voice_lengths: list[int], time_budget: float | None, workers: int, max_timelimit: float,
+                      min_timelimit: float = 60) -> list[float]:
+    """
+    Распределение времени стилизации между голосами пропорционально их длине
+
+    :param voice_lengths: Количество сообщений в каждом голосе
+    :param time_budget: Общее время стилизации всех голосов (None - каждому голосу max_timelimit)
+    :param workers: Количество голосов, стилизуемых одновременно
+    :param max_timelimit: Наибольшее время на один голос
+    :param min_timelimit: Наименьшее время на один голос
+    :return: Ограничение времени для каждого голоса
+    """
+    if time_budget is None:
+        return [max_timelimit] * len(voice_lengths)
+    total_length = max(sum(voice_lengths), 1)
+    worker_seconds = time_budget * workers  # за общее время воркеры вместе успевают столько
+    return [min(max(worker_seconds * length / total_length, min_timelimit), max_timelimit) for length in voice_lengths]
+
 
 class PerformerWrapper:
-    def __init__(self, style_performer_path: Path, midi_style: Path):
+    def __init__(self, style_performer_path: Path, midi_style: Path, max_workers: int = 1,
+                 time_budget: float | None = None, timelimit=1200, A=30, B=1, stride=1, dt_max=0.0,
+                 cache_dir: Path | None = None, cache_max_bytes=1 << 30):
+        """
+        :param max_workers: Количество процессов стилизации (голоса стилизуются параллельно); 1 - в текущем процессе.
+                            Каждый процесс загружает свою модель Performer, поэтому по умолчанию процесс один
+        :param time_budget: Общее время стилизации в секундах, распределяется между голосами по длине (None - без общего ограничения)
+        :param timelimit: Наибольшее время стилизации одного голоса
+        :param cache_dir: Папка кэша стилизованных голосов (None - без кэша)
+        :param cache_max_bytes: Наибольший размер кэша
+        """
         assert style_performer_path.exists()
 
         self.style_performer_path = style_performer_path
+        self.midi_style = midi_style
+        self.max_workers = max(max_workers, 1)
+        self.time_budget = time_budget
+        self.timelimit = timelimit
+        self.style_parameters = {'A': A, 'B': B, 'stride': stride, 'dt_max': dt_max}
 
-        sys.path.insert(0, f"{style_performer_path}/src")  # TODO: некостыльный динамичный import
-        from performance.performer import Performer
+        self.performer_cls = _import_performer(style_performer_path)
 
-        self.performer_cls = Performer
-        self.midi_style = midi_style
+        # Результат стилизации зависит от голоса, стиля, конфигурации и параметров (но не от ограничения времени)
+        self.cache = StyleCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+        self._cache_parameters = None
+        if self.cache is not None:
+            self._cache_parameters = (path_content_hash(midi_style),
+                                      path_content_hash(Path(f"{style_performer_path}/config/config_0025")),
+                                      sorted(self.style_parameters.items()))
 
     def stylize(self, mono_mid, voice_count):
-        # Запускаем перенос стиля
-        mono_mid_styled = []  # массив одноголосных миди со стилем
-        for i in range(voice_count):
-            mono_mid_styled.append(MidiFile())
-            mono_mid_styled[i].ticks_per_beat = 120
-            mono_mid_styled[i].type = 1
-            mono_mid_styled[i].add_track('Acoustic Guitar')
-
+        with metrics.timer('stylizing.stylize', voices=voice_count) as fields:
+            # Запускаем перенос стиля
+            mono_mid_styled = list(mono_mid[:voice_count])  # массив одноголосных миди со стилем (короткие голоса - без изменений)
+            voices = []  # голоса для стилизации
+            for i in range(voice_count):
+                if len(mono_mid[i].tracks[0]) > 128:
+                    voices.append(i)
+            fields['stylizable'] = len(voices)
+
+            # Голоса, уже стилизованные с теми же стилем, конфигурацией и параметрами, берем из кэша
+            cache_keys = {}
+            if self.cache is not None:
+                for i in list(voices):
+                    cache_keys[i] = self.cache.key(mono_mid[i], *self._cache_parameters)
+                    cached_mid = self.cache.get(cache_keys[i])
+                    if cached_mid is not None:
+                        mono_mid_styled[i] = cached_mid
+                        voices.remove(i)
+                fields['cached'] = fields['stylizable'] - len(voices)
+
+            if voices:
+                workers = min(self.max_workers, len(voices))
+                voice_lengths = [len(mono_mid[i].tracks[0]) for i in voices]
+                timelimits = voice_time_limits(voice_lengths, self.time_budget, workers, self.timelimit)
+                if workers == 1:
+                    styled = self._stylize_in_process(mono_mid, voices, timelimits)
+                else:
+                    styled = self._stylize_in_pool(mono_mid, voices, voice_lengths, timelimits, workers)
+                for i, voice_mid in styled.items():
+                    mono_mid_styled[i] = voice_mid
+                    if self.cache is not None:
+                        self.cache.put(cache_keys[i], voice_mid)
+                fields.update(workers=workers, stylized=len(styled), failed=len(voices) - len(styled))
+
+            # Собираем все midi вместе в многоголосный трек (в порядке голосов)
+            return merge_tracks(mono_mid_styled, voice_count)
+
+    def _stylize_in_process(self, mono_mid, voices: list[int], timelimits: list[float]) -> dict[int, MidiFile]:
         p = self.performer_cls()  # класс-фасад
         p.compile(f"{self.style_performer_path}/config/config_0025", 'config.json')  # загрузить конфигурацию
         style = MidiFile(self.midi_style)
-        for i in range(voice_count):
-            if len(mono_mid[i].tracks[0]) > 128:
-                print(f"Стилизация голоса {i + 1} из {voice_count}")
-                mono_mid_styled[i] = p.style(mono_mid[i], style, A=30, B=1, stride=1, dt_max=0.0, verbose=1, timelimit=1200)  # стилизация
-            else:
-                print(f"Голос {i} не поддается стилизации")
-                mono_mid_styled[i] = mono_mid[i]
-
-        # Собираем все midi вместе в многоголосный трек
-        return merge_tracks(mono_mid_styled, voice_count)
+        styled = {}
+        for i, timelimit in zip(voices, timelimits):
+            with metrics.timer('stylizing.voice', voice=i + 1, messages=len(mono_mid[i].tracks[0]), timelimit=timelimit):
+                styled[i] = p.style(mono_mid[i], style, **self.style_parameters, verbose=1, timelimit=timelimit)  # стилизация
+        return styled
+
+    def _stylize_in_pool(self, mono_mid, voices: list[int], voice_lengths: list[int], timelimits: list[float],
+                         workers: int) -> dict[int, MidiFile]:
+        styled = {}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_style_worker,
+                                 initargs=(self.style_performer_path, self.midi_style)) as executor:
+            # Самые длинные голоса запускаются первыми - так общее время меньше
+            order = sorted(range(len(voices)), key=lambda k: voice_lengths[k], reverse=True)
+            futures = {}
+            for k in order:
+                futures[executor.submit(_style_voice, mono_mid[voices[k]], self.style_parameters, timelimits[k])] = k
+
+            for future in as_completed(futures):
+                k = futures[future]
+                i = voices[k]
+                try:
+                    styled[i], seconds = future.result()
+                    metrics.event('stylizing.voice', voice=i + 1, messages=voice_lengths[k], timelimit=timelimits[k],
+                                  seconds=round(seconds, 6))
+                except Exception as error:
+                    print(f"Не удалось стилизовать голос {i + 1}", type(error).__name__, "–", error)
+                    metrics.event('stylizing.voice', voice=i + 1, messages=voice_lengths[k], timelimit=timelimits[k],
+                                  failed=f"{type(error).__name__} – {error}")
+        return styled
 
 
 def merge_tracks(mid_array, voice_count):
     """ Функция для объединения треков в едином масштабе времени """
-    # Объединение треков нескольких объектов MidFile в один трек
-    # Запишем время события из каждого трека в dictionary, каждый элемент которого - массив сообщений в данный момент времени
-    merged_track = defaultdict(list)
-    # Для каждого миди
-    for voice in range(voice_count):
-        mid = mid_array[voice]
-        # Для каждого трека
-        for track in mid.tracks:
-            time = 0  # Время нарастающим итогом т.е. рассматриваем разницу между нотами, а не время с самого начала
-            # Для каждого сообщения в треке
-            for message in track:
-                # Если сообщение о нажатии или отпускании ноты
-                if message.type in ("note_on", "note_off"):
-                    message_type = message.type
-                    # Если time_on и velocity=0, то это событие равнозначно note_off
-                    if message.type == "note_on" and message.velocity == 0:
-                        message_type = "note_off"
-
-                    # Рассчитаем текущий момент времени для нового сообщения
-                    time += message.time
-
-                    if message.channel != 10: # Дизейблим перкуссию (10 канал по стандарту МИДИ используется для перкуссии.)
-                        merged_track[time].append({'type': message_type, 'note': message.note, 'velocity': message.velocity})
+    # Объединение треков нескольких объектов MidFile в один трек: каждый трек уже упорядочен по времени,
+    # поэтому треки сливаются потоково (k-путевое слияние), без промежуточного словаря всех событий
+    streams = [track_note_events(track) for mid in mid_array[:voice_count] for track in mid.tracks]
 
     # Создаем новую переменную для обозначения миди-файла
     merged_mid = MidiFile()
-    # Вычисляем масштаб для пересчета темпа
-    ticks_per_beat_factor = set_time_factor(mid.ticks_per_beat)
+    # Вычисляем масштаб для пересчета темпа (по последнему голосу)
+    ticks_per_beat_factor = set_time_factor(mid_array[voice_count - 1].ticks_per_beat)
     # if debug: print(f'Исходная композиция. Количество тиков в четверти: {mid.ticks_per_beat}')
     # Темп всегда 120 ударов на целую ноту
     merged_mid.ticks_per_beat = 120
     # Создаем первый и единственный трек
     merged_mid.add_track('Acoustic Grand Piano')
-    time = 0  # Начальная метка времени
-    # Для каждого момента времени в словаре (сортируем его по времени), записываем событие в midi.
-    for moment in sorted(merged_track.keys()):
-        # if debug: print(moment, ':', merged_track[moment])
-        # Рассчитаем промежуток времени от предыдущего события
-        delta_t = int(moment - time)
-        # Перебираем все сообщения в текущем моменте времени
-        for event in merged_track[moment]:
-            # Формируем сообщение в формате midi
-            merged_mid.tracks[0].append(Message(event.get('type'), note=event.get('note'), velocity=event.get('velocity'), time=retime(delta_t, ticks_per_beat_factor)))
-            # Все остальные события в этот момент времени имеют delta_t=0
-            delta_t = 0
-        # Переключаем момент времени на новую отметку
-        time = moment
+    # События всех голосов по времени; промежуток от предыдущего события вычисляется при слиянии
+    for delta_t, (message_type, note, velocity) in with_delta_times(merge_streams(streams)):
+        # Формируем сообщение в формате midi
+        merged_mid.tracks[0].append(Message(message_type, note=note, velocity=velocity, time=retime(delta_t, ticks_per_beat_factor)))
 
     merged_mid.tracks[0].append(UnknownMetaMessage(type_byte=123, time=0))  # MetaMessage('end_of_track')
 
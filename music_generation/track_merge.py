@@ -0,0 +1,50 @@
+import heapq
+from typing import Iterable, Iterator, TypeVar
+
+from mido import MidiTrack
+
+Event = TypeVar('Event')
+
+
+def merge_streams(streams: Iterable[Iterable[tuple[int, Event]]]) -> Iterator[tuple[int, Event]]:
+    """
+    Потоковое k-путевое слияние упорядоченных по времени потоков событий
+
+    :param streams: Потоки (время от начала, событие); время внутри каждого потока не убывает
+    :return: События всех потоков по возрастанию времени; в один момент времени - сначала события более раннего потока,
+             внутри потока - в исходном порядке
+    """
+    # heapq.merge устойчиво: при равных ключах первым выдается элемент потока с меньшим номером
+    return heapq.merge(*streams, key=lambda timed_event: timed_event[0])
+
+
+def with_delta_times(timed_events: Iterable[tuple[int, Event]]) -> Iterator[tuple[int, Event]]:
+    """ Замена абсолютного времени событий на промежуток от предыдущего события (время в midi-сообщениях) """
+    previous_time = 0
+    for time, event in timed_events:
+        yield time - previous_time, event
+        previous_time = time
+
+
+def track_note_events(track: MidiTrack, percussion_channel=10) -> Iterator[tuple[int, tuple[str, int, int]]]:
+    """
+    Нотные события трека с временем от начала трека (время складывается только из нотных сообщений)
+
+    :param track: Трек midi-файла
+    :param percussion_channel: Канал перкуссии, события которого пропускаются
+    :return: Поток (время, (тип, нота, velocity)); note_on с velocity=0 заменяется на note_off
+    """
+    time = 0  # Время нарастающим итогом т.е. рассматриваем разницу между нотами, а не время с самого начала
+    for message in track:
+        # Если сообщение о нажатии или отпускании ноты
+        if message.type in ("note_on", "note_off"):
+            message_type = message.type
+            # Если time_on и velocity=0, то это событие равнозначно note_off
+            if message.type == "note_on" and message.velocity == 0:
+                message_type = "note_off"
+
+            # Рассчитаем текущий момент времени для нового сообщения
+            time += message.time
+
+            if message.channel != percussion_channel:
+                yield time, (message_type, message.note, message.velocity)
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from .vertex_table import VertexTable
+
+CHORD_DTYPE = np.dtype(np.uint8)  # ноты аккорда (0..127)
+VERTEX_DTYPE = np.dtype('<u4')  # номера аккордов окна вершины
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS chords (id INTEGER PRIMARY KEY, notes BLOB NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS vertices (id INTEGER PRIMARY KEY, chords BLOB NOT NULL UNIQUE);
+"""
+
+
+class VertexStore:
+    """
+    Словарь вершин графа де Брюйна на диске (SQLite в режиме WAL).
+
+    Номера те же, что в VertexTable: плотные, вершина 0 - терминальная; аккорд хранится один раз (ноты - blob uint8),
+    вершина - blob номеров аккордов окна. Вершины файла вставляются одной транзакцией (вставка или получение номера),
+    поэтому после сбоя в словаре остаются все вершины файлов, обработанных до него.
+    Писать могут сразу несколько потоков и процессов: у каждого свое соединение, транзакции записи SQLite выполняет
+    по очереди, а читатели в режиме WAL писателей не ждут.
+    """
+    BUSY_TIMEOUT_MS = 60_000  # ожидание транзакции другого писателя
+
+    def __init__(self, path: Path, terminator: int = 0):
+        self.path = path
+        self.terminator = terminator
+        self._local = threading.local()
+
+        self.created = not path.exists()  # номера вершин в ранее записанных графах недействительны
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        with self._transaction(connection):
+            for statement in _SCHEMA.strip().split(';'):
+                if statement.strip():
+                    connection.execute(statement)
+            row = connection.execute("SELECT value FROM meta WHERE key = 'terminator'").fetchone()
+            if row is None:
+                connection.execute("INSERT INTO meta (key, value) VALUES ('terminator', ?)", (terminator,))
+                connection.execute("INSERT INTO vertices (id, chords) VALUES (?, ?)", (VertexTable.TERMINATOR_ID, b''))
+            elif row[0] != terminator:
+                raise ValueError(f"Vertex store {path} has terminator {row[0]}, expected {terminator}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Соединение текущего потока (после fork процесс-воркер открывает свое) """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            connection.execute(f"PRAGMA busy_timeout={self.BUSY_TIMEOUT_MS}")
+            connection.execute("PRAGMA synchronous=NORMAL")  # в режиме WAL зафиксированная транзакция переживает сбой процесса
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    @contextmanager
+    def _transaction(connection: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+        """ Транзакция записи: блокировка берется сразу (BEGIN IMMEDIATE), чтобы писатели не мешали друг другу на середине """
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def __len__(self):
+        return self._connection().execute("SELECT MAX(id) + 1 FROM vertices").fetchone()[0]
+
+    @staticmethod
+    def _insert_or_get(connection: sqlite3.Connection, table: str, column: str, keys: list[bytes]) -> list[int]:
+        """ Номера ключей в таблице: новые ключи получают следующие свободные номера (с 0) в порядке списка """
+        connection.executemany(f"INSERT OR IGNORE INTO {table} (id, {column}) "
+                               f"VALUES ((SELECT COALESCE(MAX(id) + 1, 0) FROM {table}), ?)", ((key,) for key in keys))
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (position INTEGER PRIMARY KEY, key BLOB NOT NULL)")
+        connection.execute("DELETE FROM lookup")
+        connection.executemany("INSERT INTO lookup (position, key) VALUES (?, ?)", enumerate(keys))
+        rows = connection.execute(f"SELECT {table}.id FROM lookup JOIN {table} ON {table}.{column} = lookup.key "
+                                  "ORDER BY lookup.position").fetchall()
+        return [row[0] for row in rows]
+
+    def merge(self, other: VertexTable) -> np.ndarray:
+        """
+        Вставка вершин таблицы файла одной транзакцией (как VertexTable.merge)
+
+        :return: Массив перекодировки: номер вершины в `other` -> номер вершины в словаре
+        """
+        remap = np.empty(len(other), dtype=np.uint64)
+        remap[VertexTable.TERMINATOR_ID] = VertexTable.TERMINATOR_ID
+        connection = self._connection()
+        with self._transaction(connection):
+            chord_ids = np.array(self._insert_or_get(connection, 'chords', 'notes',
+                                                     [np.array(chord, dtype=CHORD_DTYPE).tobytes() for chord in other.chords]),
+                                 dtype=VERTEX_DTYPE)
+            vertex_keys = [chord_ids[list(vertex)].tobytes() for vertex in other.vertices[1:]]
+            remap[1:] = self._insert_or_get(connection, 'vertices', 'chords', vertex_keys)
+        return remap
+
+    def to_vertex_table(self) -> VertexTable:
+        """ Весь словарь в памяти - для генерации (генератору нужны окна аккордов вершин графа) """
+        connection = self._connection()
+        chords = [tuple(np.frombuffer(notes, dtype=CHORD_DTYPE).tolist())
+                  for notes, in connection.execute("SELECT notes FROM chords ORDER BY id")]
+        vertices = [tuple(np.frombuffer(key, dtype=VERTEX_DTYPE).tolist())
+                    for key, in connection.execute("SELECT chords FROM vertices ORDER BY id")]
+        return VertexTable.from_lists(self.terminator, chords, vertices)
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+        self._local = threading.local()
@@ -0,0 +1,75 @@
+import numpy as np
+
+Chord = tuple[int, ...]  # ноты аккорда (номера клавиш midi)
+Window = tuple[Chord, ...]  # окно из L аккордов - содержимое вершины графа де Брюйна
+
+
+class VertexTable:
+    """
+    Таблица интернирования вершин графа де Брюйна.
+
+    Каждому окну аккордов выдается плотный 64-битный идентификатор без коллизий (0, 1, 2, ...),
+    каждый аккорд хранится один раз, а вершина - как кортеж номеров аккордов.
+    Идентификатор 0 зарезервирован за терминальной вершиной.
+    """
+    TERMINATOR_ID = 0
+
+    def __init__(self, terminator: int = 0):
+        self.terminator = terminator
+
+        self.chords: list[Chord] = []  # номер аккорда -> ноты
+        self._chord_ids: dict[Chord, int] = {}
+
+        self.vertices: list[tuple[int, ...]] = [()]  # номер вершины -> номера аккордов окна; терминальная вершина пустая
+        self._vertex_ids: dict[tuple[int, ...], int] = {}
+
+    def __len__(self):
+        return len(self.vertices)
+
+    def intern_chord(self, chord: Chord) -> int:
+        chord_id = self._chord_ids.get(chord)
+        if chord_id is None:
+            chord_id = self._chord_ids[chord] = len(self.chords)
+            self.chords.append(chord)
+        return chord_id
+
+    def intern(self, window: Window) -> int:
+        """ Идентификатор вершины для окна аккордов (новое окно получает следующий свободный номер) """
+        key = tuple(self.intern_chord(tuple(chord)) for chord in window)
+        vertex_id = self._vertex_ids.get(key)
+        if vertex_id is None:
+            vertex_id = self._vertex_ids[key] = len(self.vertices)
+            self.vertices.append(key)
+        return vertex_id
+
+    def window(self, vertex_id: int) -> Window:
+        """ Окно аккордов вершины (для терминальной вершины - пустой кортеж) """
+        return tuple(self.chords[chord_id] for chord_id in self.vertices[vertex_id])
+
+    def merge(self, other: 'VertexTable') -> np.ndarray:
+        """
+        Вставка вершин другой таблицы (например, разобранного в отдельном процессе файла)
+
+        :return: Массив перекодировки: номер вершины в `other` -> номер вершины в этой таблице
+        """
+        chord_remap = [self.intern_chord(chord) for chord in other.chords]
+        remap = np.empty(len(other), dtype=np.uint64)
+        remap[self.TERMINATOR_ID] = self.TERMINATOR_ID
+        for vertex_id in range(1, len(other)):
+            key = tuple(chord_remap[chord_id] for chord_id in other.vertices[vertex_id])
+            new_id = self._vertex_ids.get(key)
+            if new_id is None:
+                new_id = self._vertex_ids[key] = len(self.vertices)
+                self.vertices.append(key)
+            remap[vertex_id] = new_id
+        return remap
+
+    @classmethod
+    def from_lists(cls, terminator: int, chords: list[Chord], vertices: list[tuple[int, ...]]) -> 'VertexTable':
+        """ Таблица из готовых списков: номер аккорда -> ноты, номер вершины -> номера аккордов (вершина 0 - терминальная) """
+        table = cls(terminator)
+        table.chords = chords
+        table._chord_ids = {chord: chord_id for chord_id, chord in enumerate(chords)}
+        table.vertices = vertices
+        table._vertex_ids = {key: vertex_id for vertex_id, key in enumerate(vertices) if vertex_id != cls.TERMINATOR_ID}
+        return table
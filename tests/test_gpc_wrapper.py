@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from music_generation import GPCWrapper
+from music_generation.fake_gpc import FakeGPC
+from music_generation.vertex_table import VertexTable
+
+
+def _graph() -> tuple[VertexTable, pd.DataFrame]:
+    """ Небольшой граф: цепочки аккордов с ветвлениями и тупиком, из которого обход возвращается в терминальную вершину """
+    vertex_table = VertexTable()
+    chords = [(60, 64, 67), (62, 65, 69), (64, 67, 71), (60, 65, 69), (59, 62, 67), (57, 60, 64)]
+    windows = [((0,), chords[i], chords[(i + 1) % len(chords)]) for i in range(len(chords))]
+    vertices = [vertex_table.intern(window) for window in windows]
+
+    edges = [(VertexTable.TERMINATOR_ID, vertices[0], 0), (VertexTable.TERMINATOR_ID, vertices[3], 0)]
+    for i, vertex in enumerate(vertices[:-1]):
+        edges.append((vertex, vertices[i + 1], 60 + i))
+        edges.append((vertex, vertices[(i + 2) % (len(vertices) - 1)], 120))
+    edges.append((vertices[-1], VertexTable.TERMINATOR_ID, 0))
+    return vertex_table, pd.DataFrame(edges, columns=['from', 'to', 'atribute']).astype(np.uint64)
+
+
+def _generate(work_dir: Path, bulk_receive: bool, chord_count: int):
+    (work_dir / "sw-kernel.rawbinary").touch()
+    (work_dir / "sw_kernel.h").touch()
+    vertex_table, edges = _graph()
+    generator = GPCWrapper(work_dir / "sw-kernel.rawbinary", work_dir / "sw_kernel.h", vertex_table,
+                           gpc_factory=lambda: FakeGPC(seed=7), bulk_receive=bulk_receive, receive_chunk_edges=16)
+    generator.init()
+    generator.insert_graph(edges)
+
+    walk = []
+    generator._start_random_traversal(chord_count, VertexTable.TERMINATOR_ID)
+    for _ in range(chord_count):
+        walk.append(generator._get_random_edge())
+    round_trips = generator.queue_round_trips
+
+    midi = generator.generate_midi(chord_count, 128)
+    generator.close()
+    return walk, round_trips, midi
+
+
+@pytest.mark.parametrize('chord_count', [1, 16, 100])
+def test_bulk_receive_matches_word_by_word(tmp_path, chord_count):
+    word_walk, word_round_trips, word_midi = _generate(tmp_path, False, chord_count)
+    bulk_walk, bulk_round_trips, bulk_midi = _generate(tmp_path, True, chord_count)
+
+    assert bulk_walk == word_walk
+    assert all(isinstance(value, int) for edge in bulk_walk for value in edge)
+    assert word_round_trips == 4 * chord_count
+    assert bulk_round_trips == -(-chord_count // 16)
+
+    word_edges, word_origin, word_mono, word_voices = word_midi
+    bulk_edges, bulk_origin, bulk_mono, bulk_voices = bulk_midi
+    assert (bulk_edges, bulk_voices) == (word_edges, word_voices)
+    assert bulk_origin.tracks[0] == word_origin.tracks[0]
+    assert [mid.tracks[0] for mid in bulk_mono] == [mid.tracks[0] for mid in word_mono]